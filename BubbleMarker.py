@@ -1,6 +1,86 @@
-from views import MainWindow
+import argparse
+import sys
+from functools import partial
 
 
-if __name__ == '__main__':
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='BubbleMarker', description='Place numbered marks on images')
+    parser.add_argument(
+        '--trace', metavar='FILE', help='record hot path timings and write them as a Chrome / Perfetto trace on exit')
+    parser.add_argument(
+        '--startup-profile', action='store_true',
+        help='print the time of each startup phase and the slowest imports to stderr once the window is up')
+    commands = parser.add_subparsers(dest='command')
+
+    render = commands.add_parser('render', help='apply stored marks to a folder of images without the GUI')
+    render.add_argument('--input', required=True, help='folder with the source images')
+    render.add_argument('--marks', help='JSON file of file name -> list of [x, y] mark coordinates')
+    render.add_argument('--output', required=True, help='folder for the rendered images')
+    render.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the CPU count')
+    render.add_argument('--resize-width', type=int, default=None, help='defaults to resize_image_width from config')
+    render.add_argument('--resize-height', type=int, default=None, help='defaults to resize_image_height from config')
+    render.add_argument('--only-marked', action='store_true', help='skip images without marks')
+    render.add_argument(
+        '--copy-unmarked', choices=['link', 'copy'], default=None,
+        help='hard link or copy images without marks as they are, defaults to copy_unmarked from config')
+    return parser.parse_args(argv)
+
+
+def render(args: argparse.Namespace) -> int:
+    from config import config
+    from controllers.batch_renderer import BatchRenderer, load_marks
+    from instrumentation import tracer
+
+    renderer = BatchRenderer(
+        args.input, args.output, load_marks(args.marks) if args.marks else {}, workers=args.workers,
+        resize_height=args.resize_height or config.resize_image_height,
+        resize_width=args.resize_width or config.resize_image_width,
+        only_marked=args.only_marked, copy_unmarked=args.copy_unmarked or config.copy_unmarked)
+    succeeded = renderer.run()
+    if tracer.enabled:
+        tracer.export()
+    return 0 if succeeded else 1
+
+
+def enable_tracing(args: argparse.Namespace):
+    from config import config
+    from instrumentation import tracer
+
+    if args.trace or config.instrumentation:
+        tracer.enable(args.trace or f'{config.ensure_conf_path()}/trace.json')
+
+
+def finish_startup_profile(profiler):
+    profiler.mark('first frame')
+    profiler.uninstall()
+    profiler.report()
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    profiler = None
+    if args.startup_profile:
+        from instrumentation import StartupProfiler
+
+        profiler = StartupProfiler()
+        profiler.install()
+    enable_tracing(args)
+    if args.command == 'render':
+        return render(args)
+    if profiler:
+        profiler.mark('config')
+
+    from views import MainWindow
+
+    if profiler:
+        profiler.mark('imports')
     app = MainWindow()
+    if profiler:
+        profiler.mark('window')
+        app.after_idle(partial(finish_startup_profile, profiler))  # runs once the window is drawn
     app.mainloop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
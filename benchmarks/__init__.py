@@ -0,0 +1 @@
+from .suite import main
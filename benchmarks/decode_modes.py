@@ -0,0 +1,35 @@
+import shutil
+import sys
+import tempfile
+
+from PIL import Image
+
+from config import config
+from models import MarkedImage
+
+
+def check_decode_modes(folder: str):
+    """ Images of every common mode go through the fast decode path, reduce() only handles some of them """
+    side = int(max(config.resize_image_width, config.resize_image_height) * config.reducing_gap * 2)
+    for mode in ('1', 'P', 'L', 'LA', 'RGB', 'RGBA', 'I;16'):
+        path = f'{folder}/mode_{mode.replace(";", "_")}.png'
+        Image.new(mode, (side, side)).save(path)
+        try:
+            MarkedImage(path, config.resize_image_height, config.resize_image_width).decode()
+        except (OSError, ValueError) as e:
+            raise SystemExit(f'Decoding a {mode} image failed: {e}')
+
+
+def main() -> int:
+    """ Correctness check for the decode path, run with python -m benchmarks.decode_modes, apart from the timings """
+    folder = tempfile.mkdtemp(prefix='bubblemarker-modes-')
+    try:
+        check_decode_modes(folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print('All image modes decoded')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import tkinter as tk
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from PIL import Image
+
+from views.widgets import ZoomCanvas
+
+
+class OffscreenScrollbar:
+    """ Stands in for the scrollbars of the canvas, ignores what it's told """
+
+    def set(self, lo, hi):
+        pass
+
+    def configure(self, **kw):
+        pass
+
+
+class StubCanvas(tk.Canvas):
+    """
+    Answers the tk.Canvas calls ZoomCanvas makes in Python: items are just coordinates and tags, the view is an offset.
+    Nothing is drawn, so the tiling, pyramid and resampling code of ZoomCanvas runs without a display.
+    """
+
+    def __init__(self, master=None, cnf=None, **kw):
+        self.view_size = (1280, 800)
+        self.view_x, self.view_y = 0.0, 0.0
+        self.items: Dict[int, Tuple[List[float], Tuple[str, ...]]] = {}  # item id -> coordinates, tags
+        self.jobs: Dict[str, Callable] = {}
+        self.__next_id = 0
+        self.__scan_start = (0, 0, 0.0, 0.0)
+
+    def __create(self, coords: Iterable[float], tags) -> int:
+        self.__next_id += 1
+        self.items[self.__next_id] = (list(coords), (tags,) if isinstance(tags, str) else tuple(tags))
+        return self.__next_id
+
+    def __find(self, tag_or_id) -> List[int]:
+        if isinstance(tag_or_id, int):
+            return [tag_or_id] if tag_or_id in self.items else []
+        return [item for item, (_, tags) in self.items.items() if tag_or_id == 'all' or tag_or_id in tags]
+
+    def create_rectangle(self, *args, tags=(), **kw) -> int:
+        return self.__create(args[0] if len(args) == 1 else args, tags)
+
+    create_oval = create_rectangle
+
+    def create_image(self, x: float, y: float, tags=(), **kw) -> int:
+        return self.__create((x, y), tags)
+
+    def create_text(self, x: float, y: float, tags=(), **kw) -> int:
+        return self.__create((x, y), tags)
+
+    def coords(self, tag_or_id, *args) -> List[float]:
+        found = self.__find(tag_or_id)
+        if args:
+            for item in found:
+                self.items[item] = (list(args), self.items[item][1])
+        return list(self.items[found[0]][0]) if found else []
+
+    def delete(self, *tags_or_ids):
+        for tag_or_id in tags_or_ids:
+            for item in self.__find(tag_or_id):
+                del self.items[item]
+
+    def find_withtag(self, tag_or_id) -> Tuple[int, ...]:
+        return tuple(self.__find(tag_or_id))
+
+    def scale(self, tag_or_id, x: float, y: float, x_scale: float, y_scale: float):
+        for item in self.__find(tag_or_id):
+            coords = self.items[item][0]
+            coords[0::2] = [x + (value - x) * x_scale for value in coords[0::2]]
+            coords[1::2] = [y + (value - y) * y_scale for value in coords[1::2]]
+
+    def canvasx(self, screenx, gridspacing=None) -> float:
+        return self.view_x + screenx
+
+    def canvasy(self, screeny, gridspacing=None) -> float:
+        return self.view_y + screeny
+
+    def winfo_width(self) -> int:
+        return self.view_size[0]
+
+    def winfo_height(self) -> int:
+        return self.view_size[1]
+
+    def scan_mark(self, x: int, y: int):
+        self.__scan_start = (x, y, self.view_x, self.view_y)
+
+    def scan_dragto(self, x: int, y: int, gain: int = 10):
+        start_x, start_y, view_x, view_y = self.__scan_start
+        self.view_x = view_x - (x - start_x) * gain
+        self.view_y = view_y - (y - start_y) * gain
+
+    def after(self, ms, func=None, *args) -> str:
+        self.__next_id += 1
+        job = f'after#{self.__next_id}'
+        self.jobs[job] = func
+        return job
+
+    def after_idle(self, func, *args) -> str:
+        return self.after(0, func)
+
+    def after_cancel(self, job):
+        self.jobs.pop(job, None)
+
+    def configure(self, cnf=None, **kw):
+        pass
+
+    def itemconfigure(self, tag_or_id, cnf=None, **kw):
+        pass
+
+    def lower(self, *args):
+        pass
+
+    def tag_raise(self, *args):
+        pass
+
+    def focus_set(self):
+        pass
+
+
+class OffscreenCanvas(ZoomCanvas, StubCanvas):
+    """ The real ZoomCanvas on top of StubCanvas, tiles are kept as PIL images instead of PhotoImages """
+
+    def __init__(self, view_size: Tuple[int, int] = (1280, 800)):
+        super().__init__(None)
+        self.view_size = view_size
+
+    @staticmethod
+    def make_scrollbars(image_frame: tk.Frame) -> Tuple[OffscreenScrollbar, OffscreenScrollbar]:
+        return OffscreenScrollbar(), OffscreenScrollbar()
+
+    @staticmethod
+    def make_photo_image(tile: Image.Image) -> Image.Image:
+        return tile
@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import PIL
+from PIL import Image
+
+from config import config
+from controllers import ImageMarkingController, ImageMarkingFileManager
+from models.image_cache import image_cache
+
+
+class Timer:
+    """ Collects wall-clock samples per stage """
+
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results: Dict[str, Dict] = {}
+
+    def measure(self, stage: str, run: Callable[[], None], setup: Optional[Callable[[], None]] = None, **meta):
+        samples = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            started = time.perf_counter()
+            run()
+            samples.append((time.perf_counter() - started) * 1000)
+        self.results[stage] = {
+            'median_ms': statistics.median(samples), 'mean_ms': statistics.mean(samples), 'min_ms': min(samples),
+            'max_ms': max(samples), 'runs': len(samples), **meta}
+        print(f'{stage:<28} median {self.results[stage]["median_ms"]:10.2f} ms  min {min(samples):10.2f} ms')
+
+    def skip(self, stage: str, reason: str):
+        self.results[stage] = {'skipped': reason}
+        print(f'{stage:<28} skipped: {reason}')
+
+
+def generate_folder(folder: str, count: int, width: int, height: int, image_format: str, seed: int = 0):
+    """ Synthetic photos: gradients with noise, so encoders and decoders do realistic work """
+    extension = {'jpeg': 'jpg', 'png': 'png', 'tiff': 'tif', 'bmp': 'bmp'}[image_format]
+    rng = random.Random(seed)
+    noise = Image.merge('RGB', [Image.effect_noise((width, height), 40 + 10 * i) for i in range(3)])
+    gradient = Image.linear_gradient('L').resize((width, height))
+    for i in range(count):
+        tint = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+        image = Image.composite(noise, tint, gradient.rotate(rng.randrange(360)))
+        image.save(f'{folder}/image_{i:06d}.{extension}', format=image_format.upper())
+
+
+def random_marks(controller: ImageMarkingController, count: int, seed: int = 0):
+    rng = random.Random(seed)
+    width, height = controller.image.size
+    for _ in range(count):
+        controller.add_mark(rng.randrange(width), rng.randrange(height))
+
+
+def bench_model(timer: Timer, folder: str, marks: int) -> str:
+    """ Returns the path of the first image of the folder """
+    file_manager = ImageMarkingFileManager()
+
+    def scan():
+        file_manager.open_input_folder(folder)
+        file_manager.close_session()
+
+    timer.measure('select_input_folder', scan)
+    files = file_manager.files_list
+    if not files:
+        raise SystemExit(f'No images found in {folder}')
+    timer.results['select_input_folder']['files'] = len(files)  # the images indexed, not every file listed
+    first_path = file_manager.get_item_path(0)
+    first = file_manager.get_file(0)
+
+    def decode_all():
+        for index in range(len(files)):
+            file_manager.get_file(index).image.decode()
+
+    timer.measure('marked_image_decode', decode_all, files=len(files), fast_decode=config.fast_decode)
+
+    def open_cached():
+        first.image.close()
+        first.image.open()
+
+    timer.measure('marked_image_open_cached', open_cached)
+
+    random_marks(first, marks)
+    timer.measure('render_image', first.render_image, marks=marks)
+    if marks:
+        box = first.image.mark_list[marks // 2].get_bounding_box()
+        first.get_working_image()
+        timer.measure('mark_add_incremental', lambda: first.layers.add_mark(first.image.mark_list[-1]))
+        timer.measure(
+            'mark_remove_incremental',
+            lambda: first.layers.restore(box, first.image.mark_list.overlapping(box)))
+    else:
+        timer.skip('mark_add_incremental', 'no marks, use --marks')
+        timer.skip('mark_remove_incremental', 'no marks, use --marks')
+    file_manager.close()
+    return first_path
+
+
+def bench_view(timer: Timer, image: Image.Image, events: int):
+    """ Real ZoomCanvas on a Tk root, needs a display (or Xvfb) """
+    import tkinter as tk
+    from views.widgets import ZoomCanvas
+
+    root = tk.Tk()
+    root.geometry('1280x800')
+    frame = tk.Frame(root)
+    frame.pack(fill='both', expand=True)
+    frame.grid_rowconfigure(0, weight=1)
+    frame.grid_columnconfigure(0, weight=1)
+    canvas = ZoomCanvas(frame)
+    canvas.grid(row=0, column=0, sticky='nswe')
+    root.update()
+
+    timer.measure('load_image', lambda: canvas.load_image(image))
+
+    def pan():
+        canvas.scan_mark(0, 0)
+        for i in range(events):
+            canvas.scan_dragto(-(i % 50), -(i % 30), gain=1)
+            canvas.show_image(interactive=True)
+        root.update()
+
+    timer.measure('show_image_pan', pan, events=events)
+    timer.measure('show_image_final', canvas.show_image)
+    root.destroy()
+
+
+def bench_view_offscreen(timer: Timer, image: Image.Image, events: int):
+    """ The same stages on the real ZoomCanvas code without a display, tiles are resampled but not made PhotoImages """
+    from benchmarks.offscreen import OffscreenCanvas
+
+    canvas = OffscreenCanvas()
+    timer.measure('load_image', lambda: canvas.load_image(image), offscreen=True)
+
+    def reset_levels():
+        canvas.load_image(image)  # back to scale 1
+        canvas.load_image(image, update_current=True)  # drops the pyramid levels made by the previous run
+
+    def first_zoom_out():
+        # load_image makes no levels, the first one is made when zooming out to under half the size needs it
+        zoom_out = SimpleNamespace(x=640, y=400, num=5, delta=0, state=0)  # a wheel event
+        for _ in range(3):
+            canvas.wheel(zoom_out)
+        canvas.show_image()
+
+    timer.measure('pyramid_level', first_zoom_out, setup=reset_levels, offscreen=True)
+
+    def pan():
+        canvas.scan_mark(0, 0)
+        for i in range(events):
+            canvas.scan_dragto(-(i % 50), -(i % 30), gain=1)
+            canvas.show_image(interactive=True)
+
+    timer.measure('show_image_pan', pan, setup=lambda: canvas.load_image(image), events=events, offscreen=True)
+    timer.measure('show_image_final', canvas.show_image, offscreen=True)
+
+
+def start_xvfb() -> Optional[subprocess.Popen]:
+    if os.environ.get('DISPLAY') or not shutil.which('Xvfb'):
+        return None
+    display = ':99'
+    process = subprocess.Popen(['Xvfb', display, '-screen', '0', '1920x1080x24'], stderr=subprocess.DEVNULL)
+    time.sleep(1)
+    os.environ['DISPLAY'] = display
+    return process
+
+
+def has_display() -> bool:
+    try:
+        import tkinter as tk
+        tk.Tk().destroy()
+        return True
+    except Exception:
+        return False
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Stages whose median got slower than the baseline by more than threshold percent.
+    A stage timed offscreen in one run and on a real canvas in the other measures different work, it's left out.
+    """
+    regressions = []
+    for stage, result in results['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if not base or 'median_ms' not in base or 'median_ms' not in result:
+            continue
+        if base.get('offscreen', False) != result.get('offscreen', False):
+            print(f'{stage}: not compared, only one of the runs was offscreen', file=sys.stderr)
+            continue
+        change = (result['median_ms'] - base['median_ms']) / base['median_ms'] * 100
+        if change > threshold:
+            regressions.append(f'{stage}: {base["median_ms"]:.2f} ms -> {result["median_ms"]:.2f} ms (+{change:.0f}%)')
+    return regressions
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='benchmarks', description='Time the render and view hot paths')
+    parser.add_argument('--count', type=int, default=20, help='images in the synthetic folder')
+    parser.add_argument('--size', default='4000x3000', help='WIDTHxHEIGHT of the synthetic images')
+    parser.add_argument('--format', default='jpeg', choices=['jpeg', 'png', 'tiff', 'bmp'])
+    parser.add_argument('--marks', type=int, default=200, help='marks placed for the render stages')
+    parser.add_argument('--events', type=int, default=100, help='pan events per show_image run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--folder', help='use an existing image folder instead of generating one')
+    parser.add_argument('--output', default='bench_output.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='allowed slowdown against the baseline, %%')
+    parser.add_argument('--xvfb', action='store_true', help='start Xvfb for the view stages when there is no display')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    width, height = map(int, args.size.lower().split('x'))
+    # Keep the benchmark away from the user's state and background threads
+    config.session_store = False
+    config.prefetch_enabled = False
+    config.background_indexing = False
+
+    xvfb = start_xvfb() if args.xvfb else None
+    temp_folder = None
+    try:
+        folder = args.folder
+        if not folder:
+            temp_folder = folder = tempfile.mkdtemp(prefix='bubblemarker-bench-')
+            generate_folder(folder, args.count, width, height, args.format)
+
+        timer = Timer(args.repeat)
+        view_path = bench_model(timer, folder, args.marks)
+        image_cache.clear()
+        view_image = ImageMarkingController(
+            view_path, config.resize_image_height, config.resize_image_width).get_working_image()
+        if has_display():
+            bench_view(timer, view_image, args.events)
+        else:
+            bench_view_offscreen(timer, view_image, args.events)
+    finally:
+        if temp_folder:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+        if xvfb:
+            xvfb.terminate()
+
+    results = {
+        'meta': {
+            'count': args.count, 'size': args.size, 'format': args.format, 'marks': args.marks,
+            'events': args.events, 'repeat': args.repeat, 'python': platform.python_version(),
+            'pillow': PIL.__version__, 'platform': platform.platform(),
+            'resize': [config.resize_image_width, config.resize_image_height]},
+        'stages': timer.results}
+    with open(args.output, 'w') as _f:
+        _f.write(json.dumps(results, indent=2))
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as _f:
+            regressions = compare(results, json.loads(_f.read()), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
@@ -1 +1 @@
-from .config import config
+from .config import config, SizeSetting
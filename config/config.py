@@ -1,6 +1,7 @@
 import json
 import platform
 from pathlib import Path
+from typing import Optional
 import os
 
 
@@ -9,11 +10,22 @@ class UnknownPlatformException(Exception):
 
 
 class Config(object):
+    """
+    Settings singleton. Nothing is read or written on import: the defaults and config.json are loaded
+    on the first access of a setting, and the config folder is made only when something is saved into it.
+    """
 
     APP_NAME = 'BubbleMarker'
     SAVE_CONFIG_KEYS = [
         'max_width', 'max_height', 'app_title', 'window_min_size_y', 'window_min_size_x', 'menu_block_width',
-        'resize_image_height', 'resize_image_width', 'mark_circle_radius'
+        'resize_image_height', 'resize_image_width', 'mark_circle_radius', 'background_indexing',
+        'index_batch_size', 'index_poll_interval', 'image_cache_size', 'prefetch_enabled', 'prefetch_ahead',
+        'prefetch_behind', 'prefetch_workers', 'canvas_marks', 'tile_size', 'tile_cache_size',
+        'progressive_rendering', 'interactive_filter', 'refine_delay', 'frame_interval', 'coalesce_wheel',
+        'async_save', 'session_store', 'session_compact_after',
+        'fast_decode', 'reducing_gap', 'instrumentation', 'filmstrip', 'thumbnail_size', 'thumbnail_workers',
+        'raster_cache', 'raster_cache_size', 'rescan_interval',
+        'large_images', 'large_image_pixels', 'large_image_cache', 'copy_unmarked', 'recursive', 'file_cache_size'
     ]
 
     _instance = None
@@ -24,6 +36,8 @@ class Config(object):
         return cls._instance
 
     def __init__(self):
+        if 'conf_path' in self.__dict__:
+            return  # Config() hands out the singleton, which keeps its settings
 
         match platform.system().lower():
             case 'darwin' | 'linux':
@@ -33,11 +47,18 @@ class Config(object):
             case _:
                 raise UnknownPlatformException(f'Unsupported platform: {platform.system()}')
 
-        if not os.path.exists(conf_path):
-            os.makedirs(conf_path)
-
+        self.conf_path = conf_path
         self.file_path = f'{conf_path}/config.json'
+        self.loaded = False
+
+    def __getattr__(self, name: str):
+        """ Only called for attributes not set yet, so the settings are loaded on the first access of one """
+        if name.startswith('__') or self.__dict__.get('loaded', True):
+            raise AttributeError(name)
+        self.load_config()
+        return getattr(self, name)
 
+    def set_defaults(self):
         self.max_width = 1000
         self.max_height = 1000
         self.app_title = 'Bubble Marker'
@@ -48,24 +69,95 @@ class Config(object):
         self.resize_image_height = 1000
         self.resize_image_width = 1000
         self.mark_circle_radius = 16
+        self.background_indexing = True  # scan the input folder on a worker thread
+        self.index_batch_size = 64  # files handed over to the file list at once
+        self.index_poll_interval = 50  # ms between checks for newly indexed files
+        self.image_cache_size = 512  # MB of decoded and resized images kept in memory
+        self.prefetch_enabled = True  # decode neighbouring images in the background
+        self.prefetch_ahead = 3  # images after the current one to prefetch
+        self.prefetch_behind = 1  # images before the current one to prefetch
+        self.prefetch_workers = 2
+        self.canvas_marks = True  # show marks as canvas items while editing, they are drawn into pixels on save
+        self.tile_size = 256  # px, the visible area of the image is drawn with tiles of this size
+        self.tile_cache_size = 256  # tiles kept in memory for panning and zooming back
+        self.progressive_rendering = True  # cheaper filter while panning or zooming, full quality once input stops
+        self.interactive_filter = 'bilinear'  # 'nearest', 'bilinear' or 'lanczos'
+        self.refine_delay = 150  # ms without input before the view is redrawn in full quality
+        self.frame_interval = 16  # ms, the view is redrawn at most once per interval however many events arrive
+        self.coalesce_wheel = True  # merge wheel steps arriving within one frame into a single zoom
+        self.async_save = True  # render and write saved images on a background thread
+        self.session_store = True  # keep the marks of each input folder across restarts
+        self.session_compact_after = 10000  # logged mark operations before the log is folded into the snapshot
+        self.fast_decode = True  # JPEG draft decoding and integer reduce() before the final LANCZOS resize
+        self.reducing_gap = 2.0  # the final LANCZOS step still downscales at least this much
+        self.instrumentation = False  # record hot path timings to trace.json in the config dir, see --trace
+        self.filmstrip = True  # panel of thumbnails next to the canvas, click one to jump to it
+        self.thumbnail_size = 128  # px, thumbnails are kept on disk per size
+        self.thumbnail_workers = 2
+        self.raster_cache = False  # keep resized images on disk between sessions, memory-mapped on open
+        self.raster_cache_size = 2048  # MB on disk, least recently used rasters are removed beyond it
+        self.rescan_interval = 0  # s between checks of the input folder for new and removed files, 0 turns it off
+        self.large_images = True  # show and save big tiled TIFFs tile by tile at their native size
+        self.large_image_pixels = 100_000_000  # tiled TIFFs with at least this many pixels are large images
+        self.large_image_cache = 256  # MB of decoded tiles kept for the large image on screen
+        # 'link' or 'copy' saves images without marks as the original file, not resized and re-encoded, '' is off
+        self.copy_unmarked = ''
+        self.recursive = False  # include the images in subfolders of the input folder, saved into matching subfolders
+        self.file_cache_size = 32  # file objects kept around, ones with marks that no session holds are never dropped
 
     def load_config(self):
+        """ Defaults overridden by config.json, settings assigned before loading win over both """
+        assigned = {} if self.loaded else dict(self.__dict__)
+        self.set_defaults()
         if os.path.isfile(self.file_path):
             with open(self.file_path, 'r') as _f:
                 data = json.loads(_f.read())
-                for k, v in data:
+                for k, v in data.items():
                     setattr(self, k, v)
+        self.__dict__.update(assigned)
+        self.loaded = True
+
+    def ensure_conf_path(self) -> str:
+        os.makedirs(self.conf_path, exist_ok=True)
+        return self.conf_path
 
     def save_config(self):
+        data = self.get_data_to_save()  # before the file is truncated, the first access loads it
+        self.ensure_conf_path()
         with open(self.file_path, 'w+') as _f:
-            _f.write(json.dumps(self.get_data_to_save()))
+            _f.write(json.dumps(data))
 
     def get_data_to_save(self):
         return {k: getattr(self, k) for k in self.SAVE_CONFIG_KEYS}
 
 
+class SizeSetting:
+    """
+    Size in bytes held by an attribute, None in it means the setting (in MB) read on first use.
+    Objects made on import take their sizes this way, so importing doesn't load the config.
+    """
+
+    def __init__(self, setting: str):
+        self.setting = setting
+        self.attribute = ''
+
+    def __set_name__(self, owner, name: str):
+        self.attribute = f'_{name}'
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        size = getattr(instance, self.attribute)
+        if size is None:
+            size = getattr(config, self.setting) * 1024 * 1024
+            setattr(instance, self.attribute, size)
+        return size
+
+    def __set__(self, instance, size: Optional[int]):
+        setattr(instance, self.attribute, size)
+
+
 config = Config()
-config.load_config()
 
 if __name__ == '__main__':
     Config().load_config()
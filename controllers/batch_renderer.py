@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from controllers.image_controller import ImageMarkingController
+from controllers.save_queue import copy_atomically, save_atomically
+from models.tiled_image import TiledRender
+
+
+MarksMap = Dict[str, List[Tuple[int, int]]]
+
+
+def load_marks(marks_path: str) -> MarksMap:
+    """ Marks file is a JSON object of file name -> list of [x, y] mark coordinates on the resized image """
+    with open(marks_path, 'r') as _f:
+        data = json.loads(_f.read())
+    return {file_name: [(int(x), int(y)) for x, y in coords] for file_name, coords in data.items()}
+
+
+Job = Tuple[str, str, List[Tuple[int, int]], Optional[int], Optional[int], str]
+
+
+def render_file(job: Job) -> str:
+    """ Runs in a worker process, decodes without the image cache so memory stays bounded """
+    item_path, save_path, marks, resize_height, resize_width, copy_unmarked = job
+    if not marks and copy_unmarked in ('link', 'copy'):
+        copy_atomically(item_path, save_path, link=copy_unmarked == 'link')
+        return item_path
+    controller = ImageMarkingController(item_path, resize_height=resize_height, resize_width=resize_width)
+    for x, y in marks:
+        controller.add_mark(x, y)
+    if controller.image.is_large:
+        save_atomically(TiledRender(item_path, controller.image.mark_list), save_path)
+    else:
+        save_atomically(controller.flatten(controller.image.decode(), controller.image.mark_list), save_path)
+    return item_path
+
+
+class BatchRenderer:
+    """ Applies stored marks to a whole folder on a process pool, without any GUI """
+
+    def __init__(
+            self, input_folder: str, output_folder: str, marks: MarksMap, workers: Optional[int] = None,
+            resize_height: Optional[int] = None, resize_width: Optional[int] = None, only_marked: bool = False,
+            copy_unmarked: str = ''):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.marks = marks
+        self.workers = workers or os.cpu_count() or 1
+        self.resize_height = resize_height
+        self.resize_width = resize_width
+        self.only_marked = only_marked
+        self.copy_unmarked = copy_unmarked  # 'link' or 'copy' puts images without marks into the output as they are
+        self.done = 0
+        self.failed: List[Tuple[str, Exception]] = []
+
+    def iter_jobs(self) -> Iterator[Job]:
+        import filetype  # only the parent process lists files, workers never import it
+        with os.scandir(self.input_folder) as entries:
+            names = sorted(entry.name for entry in entries if entry.is_file())
+        for name in names:
+            if self.only_marked and name not in self.marks:
+                continue
+            item_path = f'{self.input_folder}/{name}'
+            if not filetype.is_image(item_path):
+                continue
+            yield (
+                item_path, f'{self.output_folder}/{name}', self.marks.get(name, []),
+                self.resize_height, self.resize_width, self.copy_unmarked)
+
+    def run(self, report_interval: float = 1.0) -> bool:
+        """ Render everything, reporting throughput to stderr. Returns False if any file failed """
+        os.makedirs(self.output_folder, exist_ok=True)
+        started = last_report = time.monotonic()
+        jobs = self.iter_jobs()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = {}
+            # Only a couple of jobs per worker are queued at a time, so memory doesn't grow with the folder size
+            for job in jobs:
+                in_flight[executor.submit(render_file, job)] = job[0]
+                if len(in_flight) >= self.workers * 2:
+                    self.collect(in_flight, return_when=FIRST_COMPLETED)
+                if time.monotonic() - last_report >= report_interval:
+                    self.report(started)
+                    last_report = time.monotonic()
+            while in_flight:
+                self.collect(in_flight, return_when=FIRST_COMPLETED)
+                if time.monotonic() - last_report >= report_interval:
+                    self.report(started)
+                    last_report = time.monotonic()
+        self.report(started, final=True)
+        return not self.failed
+
+    def collect(self, in_flight: Dict, return_when: str):
+        finished, _ = wait(in_flight, return_when=return_when)
+        for future in finished:
+            item_path = in_flight.pop(future)
+            error = future.exception()
+            if error:
+                self.failed.append((item_path, error))
+                print(f'Failed to render {item_path}: {error}', file=sys.stderr)
+            else:
+                self.done += 1
+
+    def report(self, started: float, final: bool = False):
+        elapsed = time.monotonic() - started
+        rate = self.done / elapsed if elapsed else 0.0
+        prefix = 'Rendered' if final else 'Rendering:'
+        print(
+            f'{prefix} {self.done} images, {len(self.failed)} failed, {elapsed:.1f} s, {rate:.1f} images/s',
+            file=sys.stderr)
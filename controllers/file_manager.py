@@ -1,34 +1,288 @@
+import bisect
 import os
-from tkinter import filedialog
-from typing import Any
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
-import filetype
+from PIL import Image
 
 from config import config
 from controllers import ImageMarkingController
+from controllers.folder_indexer import FolderIndexer, list_files
+from controllers.prefetcher import Prefetcher
+from controllers.save_queue import SaveQueue, copy_atomically, save_atomically
+from controllers.session_store import SessionStore
+from controllers.thumbnail_cache import ThumbnailCache
+from instrumentation import tracer
+from models import FileIndex
+from models.tiled_image import TiledImage
 
 
 class FileManager:
 
+    EXCLUDED_FOLDERS = ('output',)  # the default output folder is inside the input folder
+
     def __init__(self):
-        self.files_list = []
+        self.files_list = FileIndex()  # paths relative to the input folder, get_file() makes the file objects
         self.input_folder = None
         self.output_folder = None
         self.selected_file_index = 0
+        self.indexer: Optional[FolderIndexer] = None
+        self.index_error: Optional[OSError] = None  # why the last indexing couldn't list the input folder
+        self.skipped_names: Optional[Set[str]] = None  # files probe_file() turned down, as of the last (re)scan
+        self.folder_mtime: Optional[int] = None  # folder mtime of the last (re)scan, unchanged mtime skips a rescan
+        self.session: Optional[SessionStore] = None
+        self.save_queue = SaveQueue()
+        self._saving: Dict[str, Any] = {}  # save path -> file of the saves queued since the queue was last empty
+        self.prefetcher = Prefetcher(
+            self.preload_file, ahead=config.prefetch_ahead, behind=config.prefetch_behind,
+            workers=config.prefetch_workers)
+        self.thumbnails = ThumbnailCache(
+            f'{config.conf_path}/thumbnails/{config.thumbnail_size}', size=config.thumbnail_size,
+            workers=config.thumbnail_workers)
+        self._files: 'OrderedDict[str, Any]' = OrderedDict()  # path -> file object, least recently used first
+        self._kept_files: Dict[str, Any] = {}  # file objects holding state that can't be made again from the index
+        self.rescan_future: Optional[Future] = None  # recursive rescan running in the background
+        self._rescan_executor: Optional[ThreadPoolExecutor] = None
 
     def select_input_folder(self):
-        self.files_list = []
+        from tkinter import filedialog  # imported here, so the headless renderer runs without Tk
         _input_folder = filedialog.askdirectory()
         if not _input_folder:
             return
-        self.input_folder = _input_folder
-        folder_items = os.listdir(self.input_folder)
-        folder_items.sort()
-        for item in folder_items:
-            item_path = f'{self.input_folder}/{item}'
-            if os.path.isfile(item_path) and self.can_add_file(item_path):
-                self.files_list.append(self.prepare_file(item_path))
+        self.open_input_folder(_input_folder)
+
+    @tracer.traced('select_input_folder')
+    def open_input_folder(self, input_folder: str):
+        """ Start indexing the folder, the part of select_input_folder after the dialog """
+        self.stop_indexing()
+        self.prefetcher.cancel()
+        self.thumbnails.cancel()
+        self.reset_files()
+        self.input_folder = input_folder
         self.selected_file_index = 0
+        self.skipped_names = None
+        self.folder_mtime = None
+        self.index_error = None
+        self.open_session()
+        self.indexer = FolderIndexer(
+            self.input_folder, self.probe_file,
+            batch_size=config.index_batch_size, flush_interval=config.index_poll_interval / 1000,
+            recursive=config.recursive, exclude=self.get_excluded_folders())
+        if config.background_indexing:
+            self.indexer.start()
+        else:
+            self.indexer.run()
+            self.poll_index()
+
+    def poll_index(self) -> int:
+        """ Move the files indexed so far into files_list, returns the number of added files """
+        if not self.indexer:
+            return 0
+        finished = self.indexer.finished
+        added = 0
+        for batch in self.indexer.get_batches():
+            for name, file_info in batch:
+                self.files_list.append(name, file_info or None, self.get_stored_mark_count(name))
+            added += len(batch)
+        if finished:
+            if self.indexer.skipped is not None:
+                self.skipped_names = set(self.indexer.skipped)
+                self.remember_folder_mtime(self.indexer.folder_mtime)
+            self.index_error = self.indexer.error
+            self.indexer = None
+        if added:
+            self.prefetch()
+        return added
+
+    def rescan(self) -> Tuple[int, int]:
+        """
+        Pick up the files added to or removed from the input folder since it was indexed, returns (added, removed).
+        Files still there keep their state, and the current file stays the current one if it wasn't removed.
+        A recursive listing of a big tree takes a while, so it runs in the background: the call starting it
+        returns (0, 0) and a later call picks up the result, is_rescanning is True in between.
+        """
+        if not self.input_folder or self.is_indexing or self.skipped_names is None:
+            return 0, 0
+        if self.rescan_future is None:
+            args = (
+                self.input_folder, self.files_list, set(self.skipped_names), self.folder_mtime,
+                self.get_excluded_folders())
+            if not config.recursive:
+                return self.apply_changes(self.find_changes(*args))
+            if self._rescan_executor is None:
+                self._rescan_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Rescan')
+            self.rescan_future = self._rescan_executor.submit(self.find_changes, *args)
+            return 0, 0
+        if not self.rescan_future.done():
+            return 0, 0
+        future, self.rescan_future = self.rescan_future, None
+        return self.apply_changes(future.result())
+
+    @property
+    def is_rescanning(self) -> bool:
+        return self.rescan_future is not None
+
+    def find_changes(
+            self, input_folder: str, files_list: FileIndex, skipped_names: Set[str], folder_mtime: Optional[int],
+            exclude: Tuple[str, ...] = ()
+    ) -> Optional[Tuple[Optional[int], List[Tuple[str, Any]], List[str], Set[str]]]:
+        """
+        The part of rescan() that only reads the disk, it may run on a worker thread.
+        Returns the folder mtime, the added (path, file info), the removed paths and the skipped paths,
+        or None if nothing changed.
+        """
+        try:
+            new_folder_mtime = os.stat(input_folder).st_mtime_ns
+            if new_folder_mtime == folder_mtime:
+                return None  # nothing was added, removed or renamed
+            names = list_files(input_folder, config.recursive, exclude)
+        except OSError:
+            return None
+        new_names, removed = files_list.diff(names)
+        skipped_names &= set(new_names)  # skipped files are never indexed, the ones still there are new to it
+        added = []
+        for name in new_names:
+            if name in skipped_names:
+                continue
+            item_path = f'{input_folder}/{name}'
+            file_info = self.probe_file(item_path)
+            if file_info is not None:
+                added.append((name, file_info or None))
+            elif self.is_recent(item_path):
+                new_folder_mtime = None  # may be still being written, probe it again on the next rescan
+            else:
+                skipped_names.add(name)
+        return new_folder_mtime, added, removed, skipped_names
+
+    def apply_changes(self, changes: Optional[Tuple]) -> Tuple[int, int]:
+        """ Merge what find_changes() found into files_list, returns (added, removed) """
+        if changes is None:
+            return 0, 0
+        folder_mtime, added, removed, self.skipped_names = changes
+        self.remember_folder_mtime(folder_mtime)
+        current_name = self.files_list[self.selected_file_index] if self.files_list else None
+        for name in removed:
+            self.forget_file(name)
+        if added or removed:
+            self.files_list.update(
+                [(name, size, self.get_stored_mark_count(name)) for name, size in added], removed)
+
+        if current_name is not None:
+            # Where the current file is now, or the file after it if it was removed
+            index = bisect.bisect_left(self.files_list, current_name)
+            self.selected_file_index = max(0, min(index, len(self.files_list) - 1))
+        else:
+            self.selected_file_index = 0  # the folder had no files
+        if added or removed:
+            self.prefetch()
+        return len(added), len(removed)
+
+    def get_excluded_folders(self) -> Tuple[str, ...]:
+        """ Subfolders a recursive scan leaves out: the default output folder and the chosen one, if inside """
+        if not self.output_folder:
+            return self.EXCLUDED_FOLDERS
+        try:
+            output_folder = os.path.relpath(os.path.abspath(self.output_folder), os.path.abspath(self.input_folder))
+        except ValueError:
+            return self.EXCLUDED_FOLDERS  # on another drive
+        if output_folder == os.curdir or output_folder == os.pardir or output_folder.startswith(os.pardir + os.sep):
+            return self.EXCLUDED_FOLDERS
+        return self.EXCLUDED_FOLDERS + (output_folder.replace(os.sep, '/'),)
+
+    def remember_folder_mtime(self, folder_mtime: Optional[int]):
+        # A folder changed within the mtime resolution of some file systems could change again unnoticed.
+        # Files added to subfolders don't change the mtime of the folder at all.
+        recent = config.recursive or folder_mtime is None or time.time_ns() - folder_mtime < 2_000_000_000
+        self.folder_mtime = None if recent else folder_mtime
+
+    @staticmethod
+    def is_recent(item_path: str) -> bool:
+        try:
+            return time.time() - os.stat(item_path).st_mtime < 2
+        except OSError:
+            return False
+
+    def open_session(self):
+        """ Load the marks stored for the input folder, they are restored per file when it's first shown """
+        self.close_session()
+        if config.session_store:
+            self.session = SessionStore.for_input_folder(self.input_folder)
+            self.session.load()
+
+    def close_session(self):
+        if self.session:
+            self.session.close()
+            self.session = None
+
+    @property
+    def is_indexing(self) -> bool:
+        return self.indexer is not None
+
+    def prefetch(self):
+        if config.prefetch_enabled:
+            self.prefetcher.schedule(self.get_file, len(self.files_list), self.selected_file_index)
+
+    def get_file(self, index: int) -> Any:
+        """ File object of the file at index, made from the index unless it's still around """
+        name = self.files_list[index]
+        file = self._kept_files.get(name)
+        if file is not None:
+            return file
+        file = self._files.get(name)
+        if file is None:
+            file = self.prepare_file(f'{self.input_folder}/{name}', self.files_list.get_size(index), name)
+            self._files[name] = file
+            self.recycle_files()
+        else:
+            self._files.move_to_end(name)
+        return file
+
+    def recycle_files(self):
+        """ Drop the least recently used file objects past config.file_cache_size, keeping the ones with state """
+        limit = max(config.file_cache_size, self.prefetcher.ahead + self.prefetcher.behind + 1)
+        while len(self._files) > limit:
+            name, file = self._files.popitem(last=False)
+            index = self.files_list.find(name)
+            if index is not None:
+                self.files_list.mark_counts[index] = self.get_mark_count(file)
+            if self.keep_file(file):
+                self._kept_files[name] = file
+            else:
+                self.release_file(file)
+
+    def forget_file(self, name: str):
+        file = self._files.pop(name, None) or self._kept_files.pop(name, None)
+        if file is not None:
+            self.release_file(file)
+
+    def reset_files(self):
+        for file in [*self._files.values(), *self._kept_files.values()]:
+            self.release_file(file)
+        self._files.clear()
+        self._kept_files.clear()
+        self.files_list = FileIndex()
+        if self.rescan_future is not None:
+            self.rescan_future.cancel()  # one already running finishes unseen
+            self.rescan_future = None
+
+    def get_item_path(self, index: int) -> str:
+        return f'{self.input_folder}/{self.files_list[index]}'
+
+    def get_stored_mark_count(self, name: str) -> int:
+        return len(self.session.marks.get(name, ())) if self.session else 0
+
+    def stop_indexing(self):
+        if self.indexer:
+            self.indexer.stop()
+            self.indexer = None
+
+    @classmethod
+    def probe_file(cls, item_path: str) -> Optional[Tuple[int, ...]]:
+        """ Called from the indexing thread, returns the (width, height) of the file, () if unknown, None to skip it """
+        return () if cls.can_add_file(item_path) else None
 
     @staticmethod
     def can_add_file(item_path: str) -> bool:
@@ -36,19 +290,34 @@ class FileManager:
         raise NotImplementedError
 
     @staticmethod
-    def prepare_file(item_path: str) -> Any:
-        """ Wrap the file in the desired object before adding it to the list """
+    def prepare_file(item_path: str, file_info: Optional[Tuple[int, int]] = None, file_name: str = None) -> Any:
+        """ Wrap the file in the desired object when it's needed, file_name is its path relative to the input folder """
         raise NotImplementedError
 
+    @staticmethod
+    def preload_file(file: Any):
+        """ Called from the prefetch threads to get the file ready before it's shown """
+        pass
+
     def select_output_folder(self):
+        from tkinter import filedialog  # imported here, so the headless renderer runs without Tk
         _output_folder = filedialog.askdirectory()
         if not _output_folder:
             return
         self.output_folder = _output_folder
 
     def get_current_file(self):
-        return self.files_list[self.selected_file_index] if self.files_list else None
+        curr_file = self.get_file(self.selected_file_index) if self.files_list else None
+        if curr_file and self.session:
+            self.restore_file(curr_file, self.session)
+        return curr_file
+
+    @staticmethod
+    def restore_file(file: Any, session: SessionStore):
+        """ Bring back the state stored in the session, called every time the file is taken as the current one """
+        pass
 
+    @tracer.traced('save_current_file')
     def save_current_file(self):
         curr_file = self.get_current_file()
         if not curr_file:
@@ -59,25 +328,214 @@ class FileManager:
         else:
             save_path = f'{self.output_folder}/'
 
-        curr_file.render_image().save(f'{save_path}/{curr_file.image.file_name}')
+        file_name = self.get_file_name(curr_file)
+        if '/' in file_name:  # files of subfolders are saved into the same subfolders
+            os.makedirs(f'{save_path}/{os.path.dirname(file_name)}', exist_ok=True)
+        self.save_file(curr_file, f'{save_path}/{file_name}')
+
+    def save_file(self, file: Any, save_path: str):
+        """
+        Write the file to save_path, in the background when async saving is on.
+        Skipped when nothing changed since the file was last saved there.
+        """
+        signature = self.get_save_signature(file, save_path)
+        if signature is not None and signature == self.get_saved_signature(file) and \
+                (self.save_queue.is_pending(save_path) or os.path.exists(save_path)):
+            tracer.count('saves_skipped')
+            return
+        if config.copy_unmarked in ('link', 'copy') and self.is_unmarked(file):
+            source_path = self.get_file_path(file)
+            write_file = partial(copy_atomically, source_path, link=config.copy_unmarked == 'link')
+        else:
+            render = self.get_render(file)
+            write_file = lambda path: save_atomically(render(), path)
+
+        self.set_saved_signature(file, signature)
+        if config.async_save:
+            self._saving[save_path] = file
+            self.save_queue.put(save_path, write_file)
+            return
+        try:
+            write_file(save_path)
+        except BaseException:
+            self.set_saved_signature(file, None)  # so the next save tries again
+            raise
+
+    def take_save_errors(self) -> List[Tuple[str, Exception]]:
+        """ Background saves that failed since the last call, their files are saved again next time """
+        idle = not self.save_queue.pending  # checked first, a failed job reports its error before it's done
+        errors = self.save_queue.take_errors()
+        for save_path, _ in errors:
+            file = self._saving.get(save_path)
+            if file is not None:
+                self.set_saved_signature(file, None)
+        if idle:
+            self._saving.clear()
+        return errors
+
+    @staticmethod
+    def get_file_name(file: Any) -> str:
+        raise NotImplementedError
+
+    @staticmethod
+    def get_save_signature(file: Any, save_path: str) -> Any:
+        """ Everything the output of the file depends on, None to save it every time """
+        return None
+
+    @staticmethod
+    def get_saved_signature(file: Any) -> Any:
+        return None
+
+    @staticmethod
+    def set_saved_signature(file: Any, signature: Any):
+        pass
+
+    @staticmethod
+    def is_unmarked(file: Any) -> bool:
+        """ Whether the output would be the input as it is, so it can be copied through """
+        return False
+
+    @staticmethod
+    def get_mark_count(file: Any) -> int:
+        """ Stored in the index when the file object is left or dropped """
+        return 0
+
+    @staticmethod
+    def keep_file(file: Any) -> bool:
+        """ Whether the file object holds state that would be lost if it were dropped and made again """
+        return False
+
+    @staticmethod
+    def get_render(file: Any) -> Callable[[], Any]:
+        """ Snapshot of the file for saving, the returned function may be called from the save thread """
+        raise NotImplementedError
+
+    def close(self):
+        """ Stop the background work and wait for the pending saves """
+        self.stop_indexing()
+        self.prefetcher.shutdown()
+        self.thumbnails.shutdown()
+        if self._rescan_executor is not None:
+            self._rescan_executor.shutdown(wait=False, cancel_futures=True)
+            self._rescan_executor = None
+        self.save_queue.join()
+        self.close_session()
 
     def get_next_file(self, save_current: bool = False, index_modifier: int = 1):
         """ Pass 1 to get next file, or -1 to get previous one, and so on """
         if save_current:
             self.save_current_file()
         next_index = self.selected_file_index + index_modifier
-        if 0 <= next_index < len(self.files_list):
+        if 0 <= next_index < len(self.files_list) and next_index != self.selected_file_index:
+            current_file = self.get_current_file()
+            self.files_list.mark_counts[self.selected_file_index] = self.get_mark_count(current_file)
+            self.release_file(current_file)
             self.selected_file_index = next_index
+            self.prefetch()
         return self.get_current_file()
 
+    def jump_to_file(self, index: int, save_current: bool = False):
+        """ Make the file at index the current one, the files in between are not touched """
+        return self.get_next_file(save_current=save_current, index_modifier=index - self.selected_file_index)
+
+    @staticmethod
+    def release_file(file: Any):
+        """ Free what the file holds while it's not shown, called when leaving it """
+        pass
+
+    def request_thumbnails(self, indices: Iterable[int]):
+        """ Make thumbnails for the files at indices in the background, pick them up with thumbnails.take_ready() """
+        paths = {index: self.get_item_path(index) for index in indices if index < len(self.files_list)}
+        self.thumbnails.cancel(keep=paths.values())  # files scrolled out of view are not worth making anymore
+        for index, file_path in paths.items():
+            self.thumbnails.request(index, file_path)
+
+    @staticmethod
+    def get_file_path(file: Any) -> str:
+        raise NotImplementedError
+
 
 class ImageMarkingFileManager(FileManager):
     
     @staticmethod
     def can_add_file(item_path: str) -> bool:
+        import filetype  # imported on the first folder scan, it isn't needed to bring the window up
         return filetype.is_image(item_path)
 
+    @classmethod
+    def probe_file(cls, item_path: str) -> Optional[Tuple[int, int]]:
+        """ Reads only the file header, returns the image size """
+        if not cls.can_add_file(item_path):
+            return None
+        try:
+            with Image.open(item_path) as image:
+                return image.size
+        except Image.DecompressionBombError:
+            if not config.large_images:
+                return None
+            tiled = TiledImage.open_if_tiled(item_path, cache_bytes=0)  # too big for PIL, maybe not for tiles
+            if not tiled:
+                return None
+            with tiled:
+                return tiled.size
+        except (OSError, ValueError):
+            return None
+
     @staticmethod
-    def prepare_file(item_path: str) -> Any:
+    def prepare_file(
+            item_path: str, file_info: Optional[Tuple[int, int]] = None, file_name: str = None
+    ) -> ImageMarkingController:
         return ImageMarkingController(
-            image_path=item_path, resize_height=config.resize_image_height, resize_width=config.resize_image_width)
+            image_path=item_path, resize_height=config.resize_image_height, resize_width=config.resize_image_width,
+            source_size=file_info, file_name=file_name)
+
+    @staticmethod
+    def restore_file(file: ImageMarkingController, session: SessionStore):
+        file.restore_marks(session)
+
+    @staticmethod
+    def get_file_name(file: ImageMarkingController) -> str:
+        return file.image.file_name
+
+    @staticmethod
+    def get_file_path(file: ImageMarkingController) -> str:
+        return file.image.file_path
+
+    @staticmethod
+    def get_save_signature(file: ImageMarkingController, save_path: str) -> Tuple:
+        return file.get_save_signature(save_path)
+
+    @staticmethod
+    def get_saved_signature(file: ImageMarkingController) -> Optional[Tuple]:
+        return file.saved_signature
+
+    @staticmethod
+    def set_saved_signature(file: ImageMarkingController, signature: Optional[Tuple]):
+        file.saved_signature = signature
+
+    @staticmethod
+    def is_unmarked(file: ImageMarkingController) -> bool:
+        return file.image.mark_count == 0
+
+    @staticmethod
+    def get_mark_count(file: ImageMarkingController) -> int:
+        return file.image.mark_count
+
+    @staticmethod
+    def keep_file(file: ImageMarkingController) -> bool:
+        # Marks restored from or recorded in a session are brought back when the file is made again
+        return file.image.mark_count > 0 and file.session is None
+
+    @staticmethod
+    def get_render(file: ImageMarkingController) -> Callable[[], Image.Image]:
+        return file.render_snapshot()
+
+    @staticmethod
+    def preload_file(file: ImageMarkingController):
+        if not file.image.is_large:  # tiles of large images are read when they come into view
+            file.image.preload()
+
+    @staticmethod
+    def release_file(file: ImageMarkingController):
+        # The image cache keeps the decoded pixels while the budget allows
+        file.release()
@@ -0,0 +1,102 @@
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from instrumentation import tracer
+
+
+def list_files(folder: str, recursive: bool = False, exclude: Iterable[str] = ()) -> List[str]:
+    """
+    Sorted paths of the files in the folder, relative to it. When recursive, the files of subfolders are
+    listed too, except for hidden folders and the ones in exclude. Unreadable subfolders are skipped.
+    """
+    if not recursive:
+        with os.scandir(folder) as entries:
+            return sorted(entry.name for entry in entries if entry.is_file())
+    exclude = set(exclude)
+    names = []
+    subfolders = ['']
+    while subfolders:
+        prefix = subfolders.pop()
+        try:
+            with os.scandir(f'{folder}/{prefix}' if prefix else folder) as entries:
+                for entry in entries:
+                    name = f'{prefix}{entry.name}'
+                    if entry.is_dir(follow_symlinks=False):  # linked folders could loop
+                        if not entry.name.startswith('.') and name not in exclude:
+                            subfolders.append(f'{name}/')
+                    elif entry.is_file():
+                        names.append(name)
+        except OSError:
+            if not prefix:
+                raise
+    return sorted(names)
+
+
+class FolderIndexer:
+    """ Lists a folder on a worker thread and streams the accepted files back in batches """
+
+    def __init__(
+            self, folder: str, probe: Callable[[str], Any], batch_size: int = 64, flush_interval: float = 0.1,
+            recursive: bool = False, exclude: Iterable[str] = ()):
+        self.folder = folder
+        self.probe = probe  # returns file info for accepted files, or None to skip the file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # seconds, so the first files show up without waiting for a full batch
+        self.recursive = recursive  # index subfolders too
+        self.exclude = exclude  # subfolders left out, relative to the folder
+        self.skipped: Optional[List[str]] = None  # files the probe turned down, known once all files are probed
+        self.folder_mtime: Optional[int] = None  # mtime of the folder taken before listing it
+        self.error: Optional[OSError] = None
+        self.finished = False
+
+        self._batches = queue.SimpleQueue()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='FolderIndexer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @tracer.traced('index_folder')
+    def run(self):
+        try:
+            self.folder_mtime = os.stat(self.folder).st_mtime_ns
+            names = list_files(self.folder, self.recursive, self.exclude)
+            skipped = []
+            batch = []
+            last_flush = time.monotonic()
+            for name in names:
+                if self._stop_event.is_set():
+                    return
+                item_path = f'{self.folder}/{name}'
+                file_info = self.probe(item_path)
+                if file_info is not None:
+                    batch.append((name, file_info))
+                else:
+                    skipped.append(name)
+                if batch and (len(batch) >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval):
+                    self._batches.put(batch)
+                    batch = []
+                    last_flush = time.monotonic()
+            if batch:
+                self._batches.put(batch)
+            self.skipped = skipped
+        except OSError as e:
+            self.error = e
+        finally:
+            self.finished = True
+
+    def get_batches(self) -> List[List[Tuple[str, Any]]]:
+        """ Take all batches indexed so far without blocking, as (path relative to the folder, file info) """
+        batches = []
+        while True:
+            try:
+                batches.append(self._batches.get_nowait())
+            except queue.Empty:
+                return batches
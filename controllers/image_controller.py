@@ -1,36 +1,146 @@
-from PIL import ImageTk
+from copy import copy
+from typing import TYPE_CHECKING, Callable, Iterable, Optional, Tuple
+
 from PIL import Image
-from PIL.ImageDraw import ImageDraw
 
-from models import MarkedImage, CircledNumberMark
+if TYPE_CHECKING:
+    from PIL import ImageTk
+
+from config import config
+from controllers.session_store import SessionStore
+from instrumentation import tracer
+from models import MarkedImage, CircledNumberMark, ImageMark, MarkLayers
+from models.mark_layers import union_boxes
+from models.raster_cache import copy_image
+from models.tiled_image import TiledRender
 
 
 class ImageMarkingController:
 
-    def __init__(self, image_path: str, resize_height: int = None, resize_width: int = None):
-        self.image = MarkedImage(image_path, resize_height, resize_width)
+    def __init__(
+            self, image_path: str, resize_height: int = None, resize_width: int = None,
+            source_size: Optional[Tuple[int, int]] = None, file_name: str = None):
+        self.image = MarkedImage(image_path, resize_height, resize_width, source_size=source_size, file_name=file_name)
+        self.layers: Optional[MarkLayers] = None
+        self.session: Optional[SessionStore] = None  # records mark changes once the stored marks are restored
+        self.revision = 0  # bumped by every change of the marks
+        self.saved_signature: Optional[Tuple] = None  # get_save_signature() of the last save
+
+    def restore_marks(self, session: SessionStore):
+        """ Load the marks stored for the file, done once when the file is first shown """
+        if self.session is session:
+            return
+        for x, y in session.get_marks(self.image.file_name):
+            self.add_mark(x, y)
+        self.session = session
 
-    def add_mark(self, x: int, y: int):
+    def add_mark(self, x: int, y: int) -> Optional[Tuple[int, int, int, int]]:
+        """ Returns the area of the working image changed by the mark, if there is one """
         mark_number = self.image.mark_count + 1
         mark = CircledNumberMark(x, y, mark_number)
         if self.image.is_on_image(x, y):
             self.image.add_mark(mark)
+            self.revision += 1
+            if self.session:
+                self.session.add(self.image.file_name, x, y)
+            if self.layers:
+                return self.layers.add_mark(mark)
+        return None
 
-    def remove_mark(self, clear_all: bool = False):
+    def remove_mark(self, clear_all: bool = False) -> Optional[Tuple[int, int, int, int]]:
+        """ Returns the area of the working image changed by the removal, if there is one """
         if self.image.mark_count <= 0:
-            return
+            return None
+        self.revision += 1
         if clear_all:
             self.image.clear_marks()
+            if self.session:
+                self.session.clear(self.image.file_name)
+            if self.layers:
+                return self.layers.clear()
         else:
+            removed_mark = self.image.mark_list[-1]
             self.image.remove_last_mark()
+            if self.session:
+                self.session.remove(self.image.file_name, self.image.mark_count)
+            if self.layers:
+                box = removed_mark.get_bounding_box()
+                return self.layers.restore(box, self.image.mark_list.overlapping(box))
+        return None
+
+    def find_mark(self, x: int, y: int) -> Optional[int]:
+        return self.image.find_mark(x, y)
+
+    def remove_mark_at(self, position: int) -> Optional[Tuple[int, int, int, int]]:
+        """ Remove any mark, the ones after it are renumbered. Returns the changed area of the working image """
+        marks = self.image.mark_list
+        if not 0 <= position < len(marks):
+            return None
+        box = union_boxes(mark.get_bounding_box() for mark in marks[position:])  # numbers only get narrower
+        self.image.remove_mark(position)
+        self.revision += 1
+        if self.session:
+            self.session.remove(self.image.file_name, position)
+        if self.layers:
+            return self.layers.restore(box, marks.overlapping(box))
+        return None
 
+    def move_mark(self, position: int, x: int, y: int) -> Optional[Tuple[int, int, int, int]]:
+        """ Returns the changed area of the working image """
+        marks = self.image.mark_list
+        if not 0 <= position < len(marks) or not self.image.is_on_image(x, y):
+            return None
+        old_box = marks[position].get_bounding_box()
+        self.image.move_mark(position, x, y)
+        self.revision += 1
+        if self.session:
+            self.session.move(self.image.file_name, position, x, y)
+        if self.layers:
+            box = union_boxes([old_box, marks[position].get_bounding_box()])
+            return self.layers.restore(box, marks.overlapping(box))
+        return None
+
+    def get_save_signature(self, save_path: str) -> Optional[Tuple]:
+        """ Changes with anything that changes the saved output: the marks, the source file and the settings """
+        try:
+            source_key = self.image.get_cache_key()
+        except OSError:
+            return None  # the save reports what happened to the file
+        return save_path, self.revision, source_key, config.copy_unmarked
+
+    def get_working_image(self) -> Image:
+        """ Image with the marks drawn, updated in place by add_mark and remove_mark """
+        if not self.layers:
+            self.layers = MarkLayers(self.image.open(), self.image.mark_list)
+        return self.layers.image
+
+    def release(self):
+        """ Drop the working image and the decoded pixels while the file is not shown """
+        self.layers = None
+        self.image.close()
+
+    @tracer.traced('render_image')
     def render_image(self) -> Image:
-        self.image.open()
-        temp_image = self.image.image_instance.copy()
-        draw_on = ImageDraw(temp_image)
-        for mark in self.image.mark_list:
-            mark.draw(draw_on)
+        """ Flatten the marks into a new copy of the image, used for saving """
+        if self.image.is_large:
+            return TiledRender(self.image.file_path, self.image.mark_list)
+        return self.flatten(self.image.open(), self.image.mark_list)
+
+    def render_snapshot(self) -> Callable[[], Image]:
+        """ Capture the current marks, the returned function renders them and is safe to call from a worker thread """
+        image = self.image
+        marks = [copy(mark) for mark in image.mark_list]
+        if image.is_large:
+            return lambda: TiledRender(image.file_path, marks)  # rendered tile by tile while it's written
+        return lambda: self.flatten(image.preload(), marks)
+
+    @staticmethod
+    def flatten(base: Image, marks: Iterable[ImageMark]) -> Image:
+        temp_image = copy_image(base)
+        for mark in marks:
+            mark.draw(temp_image)
         return temp_image
 
-    def render_tk_image(self) -> ImageTk.PhotoImage:
+    def render_tk_image(self) -> 'ImageTk.PhotoImage':
+        from PIL import ImageTk  # needs Tk, which the headless renderer may not have
         return ImageTk.PhotoImage(self.render_image())
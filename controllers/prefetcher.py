@@ -0,0 +1,45 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+
+class Prefetcher:
+    """ Loads the files around the selected one on a thread pool, so navigation is served from memory """
+
+    def __init__(self, load: Callable[[Any], Any], ahead: int = 3, behind: int = 1, workers: int = 2):
+        self.load = load
+        self.ahead = ahead
+        self.behind = behind
+        self.workers = workers
+        self._executor = None
+        self._futures: Dict[int, Future] = {}  # keyed by id() of the file, the file manager keeps the window alive
+
+    def schedule(self, get_file: Callable[[int], Any], count: int, selected_index: int):
+        """ Queue the files in the window around selected_index, cancelling queued files outside of it """
+        window = [
+            selected_index + offset for offset in
+            list(range(1, self.ahead + 1)) + list(range(-1, -self.behind - 1, -1))
+        ]
+        files = [get_file(i) for i in window if 0 <= i < count]
+        wanted = {id(file): file for file in files}
+        for key in list(self._futures):
+            if key not in wanted:
+                self._futures.pop(key).cancel()  # files already being loaded finish and stay in the cache
+        if not wanted:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Prefetcher')
+        for key, file in wanted.items():  # next files first, the pool takes tasks in submit order
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(self.load, file)
+
+    def cancel(self):
+        """ Cancel everything that has not started yet, e.g. when the folder changes """
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+
+    def shutdown(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
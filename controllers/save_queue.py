@@ -0,0 +1,117 @@
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from instrumentation import tracer
+
+
+def get_umask() -> int:
+    umask = os.umask(0o022)  # the umask can only be read by setting it
+    os.umask(umask)
+    return umask
+
+
+NEW_FILE_MODE = 0o666 & ~get_umask()  # mode open() gives new files, mkstemp() makes them owner only
+
+
+def save_atomically(image: Image.Image, save_path: str):
+    """ Write to a temporary file next to the target and rename it, so the output is never left half written """
+    directory, file_name = os.path.split(save_path)
+    image_format = Image.registered_extensions().get(os.path.splitext(file_name)[1].lower())
+    if not image_format:
+        raise ValueError(f'Unknown file extension: {file_name}')
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{file_name}.', suffix='.tmp', dir=directory or None)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            image.save(temp_file, format=image_format)
+        os.chmod(temp_path, NEW_FILE_MODE)
+        os.replace(temp_path, save_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def copy_atomically(source_path: str, save_path: str, link: bool = False):
+    """ Put the source file itself at save_path, as a hard link if asked and possible, otherwise as a copy """
+    directory, file_name = os.path.split(save_path)
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{file_name}.', suffix='.tmp', dir=directory or None)
+    os.close(fd)
+    try:
+        linked = False
+        if link:
+            os.remove(temp_path)
+            try:
+                os.link(source_path, temp_path)
+                linked = True
+            except OSError:
+                pass  # another file system, or one without hard links
+        if not linked:
+            shutil.copyfile(source_path, temp_path)
+            shutil.copymode(source_path, temp_path)
+        os.replace(temp_path, save_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+class SaveQueue:
+    """ Renders and writes images on a worker thread, in the order they were queued """
+
+    def __init__(self):
+        self.pending = 0  # jobs queued or being written
+        self.errors: List[Tuple[str, Exception]] = []
+        self._jobs = queue.Queue()
+        self._latest: Dict[str, int] = {}  # save path -> id of its newest job, older ones are skipped
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def put(self, save_path: str, write: Callable[[str], None]):
+        """ Queue a save, write(save_path) runs on the worker thread and must not touch state shared with the UI """
+        with self._lock:
+            job_id = next(self._job_ids)
+            self._latest[save_path] = job_id
+            self.pending += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='SaveQueue', daemon=True)
+            self._thread.start()
+        self._jobs.put((job_id, save_path, write))
+
+    def _run(self):
+        while True:
+            job_id, save_path, write = self._jobs.get()
+            try:
+                with self._lock:
+                    superseded = self._latest.get(save_path) != job_id
+                if not superseded:
+                    with tracer.span('save', path=save_path):
+                        write(save_path)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append((save_path, e))
+            finally:
+                with self._lock:
+                    self.pending -= 1
+                    if self._latest.get(save_path) == job_id:
+                        del self._latest[save_path]
+                self._jobs.task_done()
+
+    def is_pending(self, save_path: str) -> bool:
+        with self._lock:
+            return save_path in self._latest
+
+    def take_errors(self) -> List[Tuple[str, Exception]]:
+        with self._lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def join(self):
+        """ Wait until everything queued so far is written """
+        self._jobs.join()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from config import config
+
+
+class SessionStore:
+    """
+    Marks of one input folder, kept across app restarts. Marks are stored by position, numbers follow from it.
+    Every mark operation is one line appended to a log, the log is folded into a JSON snapshot on compaction.
+    Both carry a generation number, so log lines already folded into a newer snapshot are skipped on load.
+    """
+
+    SNAPSHOT_NAME = 'marks.json'
+    LOG_NAME = 'marks.log'
+
+    def __init__(self, session_folder: str, compact_after: int = 10000):
+        self.session_folder = session_folder
+        self.compact_after = compact_after  # log lines replayed on load before the log is compacted
+        self.marks: Dict[str, List[List[int]]] = {}  # file name -> [x, y] of its marks, in mark order
+        self.generation = 0
+        self._log: Optional[TextIO] = None
+        self._log_lines = 0
+
+    @classmethod
+    def for_input_folder(cls, input_folder: str) -> 'SessionStore':
+        folder_hash = hashlib.sha1(os.path.abspath(input_folder).encode('utf-8')).hexdigest()
+        return cls(f'{config.conf_path}/sessions/{folder_hash}', compact_after=config.session_compact_after)
+
+    @property
+    def snapshot_path(self) -> str:
+        return f'{self.session_folder}/{self.SNAPSHOT_NAME}'
+
+    @property
+    def log_path(self) -> str:
+        return f'{self.session_folder}/{self.LOG_NAME}'
+
+    def load(self):
+        os.makedirs(self.session_folder, exist_ok=True)
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as _f:
+                data = json.loads(_f.read())
+            self.generation = data['generation']
+            self.marks = data['marks']
+        if os.path.isfile(self.log_path):
+            good_end = 0  # end of the last whole line
+            with open(self.log_path, 'rb') as _f:
+                for line in _f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        generation, operation, file_name, *args = json.loads(line)
+                    except ValueError:
+                        break  # last line was cut short by a crash
+                    good_end += len(line)
+                    if generation == self.generation:
+                        self.apply(operation, file_name, *args)
+                        self._log_lines += 1
+            if good_end < os.path.getsize(self.log_path):
+                os.truncate(self.log_path, good_end)  # so the next line isn't appended onto the torn one
+        if self._log_lines > self.compact_after:
+            self.compact()  # leaves the log open
+        else:
+            self._log = open(self.log_path, 'a')
+
+    def get_marks(self, file_name: str) -> List[Tuple[int, int]]:
+        return [(x, y) for x, y in self.marks.get(file_name, [])]
+
+    def apply(self, operation: str, file_name: str, *args: int):
+        match operation:
+            case 'add':
+                self.marks.setdefault(file_name, []).append([args[0], args[1]])
+            case 'remove':
+                file_marks = self.marks.get(file_name, [])
+                if 0 <= args[0] < len(file_marks):
+                    file_marks.pop(args[0])
+            case 'move':
+                file_marks = self.marks.get(file_name, [])
+                if 0 <= args[0] < len(file_marks):
+                    file_marks[args[0]] = [args[1], args[2]]
+            case 'clear':
+                self.marks.pop(file_name, None)
+        if file_name in self.marks and not self.marks[file_name]:
+            del self.marks[file_name]
+
+    def record(self, operation: str, file_name: str, *args: int):
+        """ Apply the operation and append it to the log """
+        self.apply(operation, file_name, *args)
+        if self._log:
+            self._log.write(json.dumps([self.generation, operation, file_name, *args]) + '\n')
+            self._log.flush()
+            self._log_lines += 1
+
+    def add(self, file_name: str, x: int, y: int):
+        self.record('add', file_name, x, y)
+
+    def remove(self, file_name: str, position: int):
+        self.record('remove', file_name, position)
+
+    def move(self, file_name: str, position: int, x: int, y: int):
+        self.record('move', file_name, position, x, y)
+
+    def clear(self, file_name: str):
+        self.record('clear', file_name)
+
+    def compact(self):
+        """ Write all marks into a new snapshot and start an empty log """
+        generation = self.generation + 1
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'w') as _f:
+            _f.write(json.dumps({'generation': generation, 'marks': self.marks}))
+        os.replace(temp_path, self.snapshot_path)
+        self.generation = generation
+        if self._log:
+            self._log.close()
+        self._log = open(self.log_path, 'w')
+        self._log_lines = 0
+
+    def close(self):
+        if self._log_lines:
+            self.compact()
+        if self._log:
+            self._log.close()
+            self._log = None
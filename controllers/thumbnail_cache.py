@@ -0,0 +1,125 @@
+import hashlib
+import os
+import pathlib
+import queue
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+from instrumentation import tracer
+from models.tiled_image import TiledImage
+
+
+class ThumbnailCache:
+    """
+    Thumbnails stored on disk in the spirit of the freedesktop thumbnail spec: PNG files carrying
+    Thumb::URI, Thumb::MTime and Thumb::Size. Files are named by the hash of the URI, mtime and size,
+    so a changed source never matches an old thumbnail.
+    Thumbnails are made by background workers, the results are picked up from the UI thread with take_ready().
+    """
+
+    def __init__(self, folder: str, size: int = 128, workers: int = 2):
+        self.folder = folder
+        self.size = size
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._futures: Dict[str, Future] = {}  # file path -> pending thumbnail
+        self._ready = queue.SimpleQueue()
+
+    @staticmethod
+    def get_signature(file_path: str) -> Tuple[str, int, int]:
+        stat = os.stat(file_path)
+        return pathlib.Path(os.path.abspath(file_path)).as_uri(), int(stat.st_mtime), stat.st_size
+
+    def get_path(self, signature: Tuple[str, int, int]) -> str:
+        key = hashlib.md5('\n'.join(map(str, signature)).encode('utf-8')).hexdigest()
+        return f'{self.folder}/{key}.png'
+
+    def get(self, file_path: str) -> Image.Image:
+        """ Thumbnail from disk, or made from the source and stored """
+        signature = self.get_signature(file_path)
+        thumbnail_path = self.get_path(signature)
+        try:
+            with Image.open(thumbnail_path) as thumbnail:
+                thumbnail.load()
+                tracer.count('thumbnail_hits')
+                return thumbnail.copy()
+        except (OSError, ValueError):
+            pass
+        return self.create(file_path, signature, thumbnail_path)
+
+    @tracer.traced('ThumbnailCache.create')
+    def create(self, file_path: str, signature: Tuple[str, int, int], thumbnail_path: str) -> Image.Image:
+        tiled = TiledImage.open_if_tiled(file_path) if file_path.lower().endswith(('.tif', '.tiff')) else None
+        if tiled:
+            with tiled:  # read from the smallest pyramid level, tile by tile
+                width, height = tiled.size
+                scale = min(self.size / width, self.size / height)
+                thumbnail = tiled.get_region(
+                    (0, 0, width, height), (max(1, round(width * scale)), max(1, round(height * scale))))
+        else:
+            with Image.open(file_path) as source:
+                source.draft('RGB', (self.size, self.size))  # JPEG is decoded at a fraction of its size
+                thumbnail = source.convert('RGBA' if 'A' in source.getbands() else 'RGB')
+            thumbnail.thumbnail((self.size, self.size))
+        from PIL.PngImagePlugin import PngInfo  # the PNG plugin loads with the first thumbnail, not on startup
+        info = PngInfo()
+        info.add_text('Thumb::URI', signature[0])
+        info.add_text('Thumb::MTime', str(signature[1]))
+        info.add_text('Thumb::Size', str(signature[2]))
+        os.makedirs(self.folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix='.png', dir=self.folder)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                thumbnail.save(temp_file, format='PNG', pnginfo=info)
+            os.replace(temp_path, thumbnail_path)
+        except OSError:
+            os.unlink(temp_path)  # a read-only cache still gives thumbnails, they just aren't kept
+        return thumbnail
+
+    def request(self, index: int, file_path: str):
+        """ Make the thumbnail in the background, it's handed out by take_ready() """
+        if file_path in self._futures:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Thumbnails')
+        self._futures[file_path] = self._executor.submit(self._make, index, file_path)
+
+    def _make(self, index: int, file_path: str):
+        thumbnail = None
+        try:
+            thumbnail = self.get(file_path)
+        except Exception:
+            pass  # any broken file, its request must still be taken off the pending ones
+        finally:
+            self._ready.put((index, file_path, thumbnail))
+
+    def take_ready(self) -> List[Tuple[int, str, Optional[Image.Image]]]:
+        """ Thumbnails made since the last call as (index, file path, image), image is None if the file failed """
+        ready = []
+        while True:
+            try:
+                index, file_path, thumbnail = self._ready.get_nowait()
+            except queue.Empty:
+                return ready
+            self._futures.pop(file_path, None)
+            ready.append((index, file_path, thumbnail))
+
+    def cancel(self, keep: Iterable[str] = ()):
+        """ Cancel the requests not started yet, except the ones for the file paths in keep """
+        keep = set(keep)
+        for file_path in [file_path for file_path in self._futures if file_path not in keep]:
+            if self._futures[file_path].cancel():
+                del self._futures[file_path]
+
+    @property
+    def pending(self) -> int:
+        return len(self._futures)
+
+    def shutdown(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
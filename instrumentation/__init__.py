@@ -0,0 +1,2 @@
+from .tracer import Tracer, tracer
+from .startup import StartupProfiler
@@ -0,0 +1,66 @@
+import builtins
+import sys
+import time
+from importlib.util import resolve_name
+from typing import Callable, List, Optional, TextIO, Tuple
+
+
+class StartupProfiler:
+    """
+    Times the modules imported while installed and the named startup phases, reported by --startup-profile.
+    Every import statement that loads new modules is timed, its self time excludes the imports nested in it.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []  # name, ms since start
+        self.imports: List[Tuple[str, float, float]] = []  # module, self ms, cumulative ms
+        self._nested: List[float] = []  # ms spent in nested imports, for each import in progress
+        self._import: Optional[Callable] = None
+
+    def install(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def mark(self, phase: str):
+        """ End of a startup phase """
+        self.phases.append((phase, (time.perf_counter() - self.started) * 1000))
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        loaded = len(sys.modules)
+        self._nested.append(0.0)
+        started = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = (time.perf_counter() - started) * 1000
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += cumulative
+            if len(sys.modules) > loaded:
+                self.imports.append((self.get_label(name, globals, fromlist, level), cumulative - nested, cumulative))
+
+    @staticmethod
+    def get_label(name: str, globals: Optional[dict], fromlist, level: int) -> str:
+        if level:
+            try:
+                name = resolve_name('.' * level + name, (globals or {}).get('__package__') or '')
+            except (ImportError, ValueError):
+                pass
+        submodules = [f'{name}.{item}' for item in fromlist or () if f'{name}.{item}' in sys.modules]
+        return ', '.join(submodules) or name  # 'from . import' loads the submodules, not the package
+
+    def report(self, file: TextIO = sys.stderr, limit: int = 25):
+        print('Startup phases, ms since start:', file=file)
+        previous = 0.0
+        for phase, at in self.phases:
+            print(f'{at:9.1f} {at - previous:+9.1f}  {phase}', file=file)
+            previous = at
+        print(f'Slowest of {len(self.imports)} imports, self ms and cumulative ms:', file=file)
+        for label, own, cumulative in sorted(self.imports, key=lambda entry: entry[1], reverse=True)[:limit]:
+            print(f'{own:9.1f} {cumulative:9.1f}  {label}', file=file)
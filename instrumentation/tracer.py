@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Deque, Dict, Optional
+
+
+class Tracer:
+    """
+    Opt-in timing spans and counters for the hot paths, exported as a Chrome / Perfetto trace JSON file.
+    While disabled every span and counter is a single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_path: Optional[str] = None
+        self.counters: Counter = Counter()
+        self.last_durations: Dict[str, float] = {}  # span name -> ms of its latest run
+        self._events: Deque[Dict] = deque()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self, trace_path: Optional[str] = None, max_events: int = 500000):
+        """ Start recording, the oldest events are dropped past max_events so long sessions stay bounded """
+        self.trace_path = trace_path
+        self._events = deque(self._events, maxlen=max_events)
+        self.enabled = True
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._origin) * 1000000
+
+    @contextmanager
+    def span(self, name: str, **args):
+        if not self.enabled:
+            yield
+            return
+        started = self._now_us()
+        try:
+            yield
+        finally:
+            duration = self._now_us() - started
+            self.last_durations[name] = duration / 1000
+            event = {
+                'name': name, 'cat': 'bubblemarker', 'ph': 'X', 'ts': started, 'dur': duration,
+                'pid': os.getpid(), 'tid': threading.get_ident()}
+            if args:
+                event['args'] = args
+            with self._lock:
+                self._events.append(event)
+
+    def traced(self, name: str) -> Callable:
+        """ Decorator wrapping every call of the function in a span """
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, value: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+            self._events.append({
+                'name': name, 'cat': 'bubblemarker', 'ph': 'C', 'ts': self._now_us(), 'pid': os.getpid(),
+                'args': {name: self.counters[name]}})
+
+    def export(self, trace_path: Optional[str] = None) -> Optional[str]:
+        """ Write the recorded events as Chrome trace JSON, loadable in chrome://tracing or ui.perfetto.dev """
+        trace_path = trace_path or self.trace_path
+        if not trace_path:
+            return None
+        with self._lock:
+            events = list(self._events)
+            counters = dict(self.counters)
+        with open(trace_path, 'w') as _f:
+            _f.write(json.dumps({
+                'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counters': counters}}))
+        return trace_path
+
+
+tracer = Tracer()
@@ -1,2 +1,5 @@
 from .image_marks import ImageMark, CircledNumberMark
+from .mark_store import MarkStore
 from .marked_image import MarkedImage
+from .mark_layers import MarkLayers
+from .file_index import FileIndex
@@ -0,0 +1,125 @@
+import bisect
+import os
+import sys
+from array import array
+from itertools import repeat
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+FS_ENCODING = sys.getfilesystemencoding()
+FS_ERRORS = sys.getfilesystemencodeerrors()  # os.fsdecode() per path is a Python call, too slow for a whole index
+
+
+class FileIndex(Sequence):
+    """
+    Files of a folder sorted by path, with their image sizes and mark counts, kept in flat arrays.
+    Paths are relative to the folder and packed into one byte buffer, instead of a string object per file.
+    Items are the relative paths, decoded on access, so the index can be searched with bisect.
+    """
+
+    def __init__(self):
+        self._paths = bytearray()  # file system encoded paths, back to back
+        self._ends = array('I')  # end of each path in _paths
+        self.widths = array('I')  # 0 if the size is not known
+        self.heights = array('I')
+        self.mark_counts = array('I')
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(index, slice):
+            return [self.get_path(i) for i in range(*index.indices(len(self._ends)))]
+        if index < 0:
+            index += len(self._ends)
+        if not 0 <= index < len(self._ends):
+            raise IndexError('file index out of range')
+        return self.get_path(index)
+
+    def __iter__(self) -> Iterator[str]:
+        paths = bytes(self._paths)
+        start = 0
+        for end in self._ends:
+            yield paths[start:end].decode(FS_ENCODING, FS_ERRORS)
+            start = end
+
+    def get_path(self, index: int) -> str:
+        start = self._ends[index - 1] if index else 0
+        return self._paths[start:self._ends[index]].decode(FS_ENCODING, FS_ERRORS)
+
+    def get_size(self, index: int) -> Optional[Tuple[int, int]]:
+        return (self.widths[index], self.heights[index]) if self.widths[index] else None
+
+    def find(self, path: str) -> Optional[int]:
+        index = bisect.bisect_left(self, path)
+        if index < len(self._ends) and self.get_path(index) == path:
+            return index
+        return None
+
+    def append(self, path: str, size: Optional[Tuple[int, int]] = None, mark_count: int = 0):
+        """ Add a file after the last one, paths must come in sorted order """
+        self._paths += os.fsencode(path)
+        self._ends.append(len(self._paths))
+        self.widths.append(size[0] if size else 0)
+        self.heights.append(size[1] if size else 0)
+        self.mark_counts.append(mark_count)
+
+    def diff(self, paths: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """ Walks the sorted paths along the index, returns the paths missing from the index and the ones gone """
+        added, removed = [], []
+        indexed = iter(self)
+        current = next(indexed, None)
+        for path in paths:
+            while current is not None and current < path:
+                removed.append(current)
+                current = next(indexed, None)
+            if current == path:
+                current = next(indexed, None)
+            else:
+                added.append(path)
+        if current is not None:
+            removed.append(current)
+            removed.extend(indexed)
+        return added, removed
+
+    def update(self, added: Iterable[Tuple[str, Optional[Tuple[int, int]], int]] = (), removed: Iterable[str] = ()):
+        """
+        Insert the added (path, size, mark count) entries at their bisect positions and drop the removed paths.
+        The stretches between the changes are copied over as whole slices, no Python work is done per file.
+        """
+        changes = [(index, 1, None) for index in map(self.find, set(removed)) if index is not None]
+        changes += [
+            (bisect.bisect_left(self, entry[0]), 0, entry) for entry in sorted(added, key=lambda entry: entry[0])]
+        if not changes:
+            return
+        changes.sort(key=lambda change: change[:2])  # stable, added ones go before the file removed at their place
+        paths, ends = bytearray(), array('I')
+        widths, heights, mark_counts = array('I'), array('I'), array('I')
+
+        def copy(begin: int, end: int):
+            if begin >= end:
+                return
+            start = self._ends[begin - 1] if begin else 0
+            shift = len(paths) - start
+            paths.extend(self._paths[start:self._ends[end - 1]])
+            stretch = self._ends[begin:end]
+            ends.extend(array('I', map(int.__add__, stretch, repeat(shift))) if shift else stretch)
+            widths.extend(self.widths[begin:end])
+            heights.extend(self.heights[begin:end])
+            mark_counts.extend(self.mark_counts[begin:end])
+
+        copied = 0
+        for index, is_removed, entry in changes:
+            copy(copied, index)
+            copied = index
+            if is_removed:
+                copied = index + 1
+                continue
+            path, size, mark_count = entry
+            paths.extend(os.fsencode(path))
+            ends.append(len(paths))
+            widths.append(size[0] if size else 0)
+            heights.append(size[1] if size else 0)
+            mark_counts.append(mark_count)
+        copy(copied, len(self._ends))
+        self._paths, self._ends = paths, ends
+        self.widths, self.heights, self.mark_counts = widths, heights, mark_counts
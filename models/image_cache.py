@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+
+from PIL import Image
+
+from config import SizeSetting
+from instrumentation import tracer
+
+
+class ImageCache:
+    """ Process-wide LRU cache of decoded images, bounded by the total size of their pixels """
+
+    max_bytes = SizeSetting('image_cache_size')
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes  # None takes config.image_cache_size
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images: 'OrderedDict[Hashable, Image.Image]' = OrderedDict()
+        self._loading: Dict[Hashable, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_image_bytes(image: Image.Image) -> int:
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key: Hashable) -> Optional[Image.Image]:
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key: Hashable, image: Image.Image):
+        image_bytes = self.get_image_bytes(image)
+        with self._lock:
+            if key in self._images:
+                self.current_bytes -= self.get_image_bytes(self._images.pop(key))
+            if image_bytes > self.max_bytes:
+                return  # would evict everything else and still not fit
+            self._images[key] = image
+            self.current_bytes += image_bytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.current_bytes -= self.get_image_bytes(evicted)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Image.Image]) -> Image.Image:
+        """ Return the cached image or load it, waiting for another thread that is already loading the same key """
+        while True:
+            with self._lock:
+                image = self._images.get(key)
+                if image is not None:
+                    self._images.move_to_end(key)
+                    self.hits += 1
+                    tracer.count('image_cache_hits')
+                    return image
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    tracer.count('image_cache_misses')
+                    break
+            loading.wait()
+            # The other thread has finished; take its result from the cache, or load it here if it failed
+
+        try:
+            image = loader()
+            self.put(key, image)
+            return image
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set()
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is not None:
+                self.current_bytes -= self.get_image_bytes(image)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.current_bytes = 0
+
+
+image_cache = ImageCache()
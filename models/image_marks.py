@@ -1,41 +1,115 @@
-from PIL import ImageFont
-from PIL.ImageDraw import ImageDraw
+from functools import lru_cache
+from typing import TYPE_CHECKING, Tuple
+
+from PIL import Image
+
+if TYPE_CHECKING:
+    from PIL import ImageDraw, ImageFont
 
 from config import config
+from instrumentation import tracer
+
+
+@lru_cache(maxsize=None)
+def get_font(font_name: str, size: int) -> 'ImageFont.FreeTypeFont':
+    """ Fonts are loaded once per process and shared by all marks, on the first mark drawn """
+    from PIL import ImageFont
+    return ImageFont.truetype(font_name, size)
 
 
 class ImageMark:
 
+    __slots__ = ('x', 'y')
+
     def __init__(self, x: int, y: int):
         self.x = x
         self.y = y
 
-    def draw(self, draw_on: ImageDraw) -> ImageDraw:
+    def draw(self, draw_on: Image, offset: Tuple[int, int] = (0, 0)) -> Image:
+        """ Draw the mark, offset is the position of draw_on's top left corner on the whole image """
+        raise NotImplementedError
+
+    def get_bounding_box(self) -> Tuple[int, int, int, int]:
+        """ Area of the image touched by draw(), as (left, upper, right, lower) """
         raise NotImplementedError
 
 
 class CircledNumberMark(ImageMark):
 
+    FONT_NAME = 'Keyboard.ttf'
+    FONT_SIZE = 16
+    FILL = 'white'
+    OUTLINE = 'red'
+    TEXT_FILL = 'black'
+
+    __slots__ = ('number',)
+
     def __init__(self, x: int, y: int, number: int):
         super().__init__(x, y)
 
         self.number = number
-        self.font = ImageFont.truetype("Keyboard.ttf", 16)
-        self.r = config.mark_circle_radius
 
-    def draw(self, draw_on: ImageDraw) -> ImageDraw:
+    @property
+    def r(self) -> int:
+        return config.mark_circle_radius
+
+    @property
+    def font(self) -> 'ImageFont.FreeTypeFont':
+        return get_font(self.FONT_NAME, self.FONT_SIZE)
+
+    @tracer.traced('CircledNumberMark.draw')
+    def draw(self, draw_on: Image, offset: Tuple[int, int] = (0, 0)) -> Image:
+        if draw_on.mode not in ('RGB', 'RGBA'):
+            # Colours of palette and grayscale images are matched by ImageDraw, so draw the shapes directly
+            from PIL.ImageDraw import ImageDraw
+            self.draw_shapes(ImageDraw(draw_on), self.x - offset[0], self.y - offset[1], self.number, self.r)
+            return draw_on
+        sprite, (center_x, center_y) = self.get_sprite(self.number, self.r)
+        draw_on.paste(sprite, (self.x - offset[0] - center_x, self.y - offset[1] - center_y), sprite)
+        return draw_on
+
+    def get_bounding_box(self) -> Tuple[int, int, int, int]:
+        sprite, (center_x, center_y) = self.get_sprite(self.number, self.r)
+        left, upper = self.x - center_x, self.y - center_y
+        return left, upper, left + sprite.width, upper + sprite.height
+
+    @classmethod
+    def draw_shapes(cls, draw_on: 'ImageDraw', x: int, y: int, number: int, r: int):
         bound_box = (
-            self.x - self.r,
-            self.y - self.r,
-            self.x + self.r,
-            self.y + self.r
+            x - r,
+            y - r,
+            x + r,
+            y + r
         )
-        draw_on.ellipse(bound_box, fill='white', outline='red', width=2)
-        text = str(self.number)
-        ascent, descent = self.font.getmetrics()
-        w = self.font.getmask(text).getbbox()[2]
-        h = self.font.getmask(text).getbbox()[3] + descent
+        draw_on.ellipse(bound_box, fill=cls.FILL, outline=cls.OUTLINE, width=2)
+        text = str(number)
+        w, h = cls.get_text_size(text)
         draw_on.text(
-            (self.x - (w/2), self.y - (h/2) - 1), text,
-            fill='black', font=self.font)
-        return draw_on
+            (x - (w/2), y - (h/2) - 1), text,
+            fill=cls.TEXT_FILL, font=get_font(cls.FONT_NAME, cls.FONT_SIZE))
+
+    @classmethod
+    def get_text_size(cls, text: str) -> Tuple[int, int]:
+        font = get_font(cls.FONT_NAME, cls.FONT_SIZE)
+        ascent, descent = font.getmetrics()
+        text_bbox = font.getmask(text).getbbox()
+        return text_bbox[2], text_bbox[3] + descent
+
+    @classmethod
+    def get_sprite(cls, number: int, r: int) -> Tuple[Image.Image, Tuple[int, int]]:
+        """ Pre-rendered transparent stamp of the mark and the position of its center on the stamp """
+        return _get_circled_number_sprite(cls, number, r, cls.FILL, cls.OUTLINE, cls.TEXT_FILL)
+
+
+@lru_cache(maxsize=4096)
+def _get_circled_number_sprite(
+        mark_class: type, number: int, r: int, fill: str, outline: str, text_fill: str
+) -> Tuple[Image.Image, Tuple[int, int]]:
+    w, h = mark_class.get_text_size(str(number))
+    # one extra pixel on each side, the ellipse includes its right and lower edge
+    center_x = max(r, w // 2 + 1) + 1
+    center_y = max(r, h // 2 + 2) + 1
+    from PIL.ImageDraw import ImageDraw  # with ImageFont, loaded by the first mark drawn rather than on startup
+    sprite = Image.new('RGBA', (2 * center_x + 1, 2 * center_y + 1), (0, 0, 0, 0))
+    mark_class.draw_shapes(ImageDraw(sprite), center_x, center_y, number, r)
+    return sprite, (center_x, center_y)
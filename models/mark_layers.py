@@ -0,0 +1,60 @@
+from typing import Iterable, Optional, Tuple
+
+from PIL import Image
+
+from models import ImageMark
+from models.raster_cache import copy_image
+
+
+Box = Tuple[int, int, int, int]
+
+
+def boxes_overlap(first: Box, second: Box) -> bool:
+    return first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
+
+
+def union_boxes(boxes: Iterable[Box]) -> Box:
+    boxes = list(boxes)
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+class MarkLayers:
+    """
+    Keeps the base raster apart from the image with the marks drawn over it.
+    A new mark is drawn only over its own bounding box, a removed one is erased by restoring its box from the base.
+    """
+
+    def __init__(self, base: Image, marks: Iterable[ImageMark]):
+        self.base = base  # shared with the image cache, never drawn on
+        self.image = copy_image(base)
+        for mark in marks:
+            mark.draw(self.image)
+
+    def clip(self, box: Box) -> Optional[Box]:
+        """ Limit the box to the image, None if nothing is left """
+        box = (max(box[0], 0), max(box[1], 0), min(box[2], self.image.width), min(box[3], self.image.height))
+        return box if box[0] < box[2] and box[1] < box[3] else None
+
+    def add_mark(self, mark: ImageMark) -> Optional[Box]:
+        """ Draw the mark on top, returns the changed area """
+        mark.draw(self.image)
+        return self.clip(mark.get_bounding_box())
+
+    def restore(self, box: Box, marks: Iterable[ImageMark]) -> Optional[Box]:
+        """ Repaint the box from the base and redraw the marks overlapping it, returns the changed area """
+        box = self.clip(box)
+        if not box:
+            return None
+        region = self.base.crop(box)
+        if region.mode != self.image.mode:
+            region = region.convert(self.image.mode)  # RGBX of a mapped raster
+        for mark in marks:
+            if boxes_overlap(mark.get_bounding_box(), box):
+                mark.draw(region, offset=box[:2])
+        self.image.paste(region, box[:2])
+        return box
+
+    def clear(self) -> Box:
+        self.image.paste(self.base, (0, 0))
+        return 0, 0, self.image.width, self.image.height
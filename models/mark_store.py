@@ -0,0 +1,108 @@
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple, Type, Union
+
+from config import config
+from models import ImageMark, CircledNumberMark
+
+
+class MarkStore:
+    """
+    Marks of one image kept in contiguous coordinate arrays, instead of an object per mark.
+    A mark's number is its position + 1, so removing or moving marks never needs renumbering by hand.
+    Marks are handed out as lightweight views built on access, changing a view doesn't change the store.
+    A grid index keyed by cells of about one mark in size keeps hit-testing cheap, it's rebuilt lazily.
+    """
+
+    def __init__(self, mark_class: Type[ImageMark] = CircledNumberMark):
+        self.mark_class = mark_class
+        self.xs = array('i')
+        self.ys = array('i')
+        self._grid: Optional[Dict[Tuple[int, int], List[int]]] = None  # cell -> positions of marks centered in it
+        self._cell_size = 0
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    def __iter__(self) -> Iterator[ImageMark]:
+        for position in range(len(self.xs)):
+            yield self.get(position)
+
+    def __getitem__(self, position: Union[int, slice]) -> Union[ImageMark, List[ImageMark]]:
+        if isinstance(position, slice):
+            return [self.get(i) for i in range(*position.indices(len(self.xs)))]
+        if position < 0:
+            position += len(self.xs)
+        if not 0 <= position < len(self.xs):
+            raise IndexError('mark position out of range')
+        return self.get(position)
+
+    def get(self, position: int) -> ImageMark:
+        return self.mark_class(self.xs[position], self.ys[position], position + 1)
+
+    def append(self, mark: ImageMark):
+        self.xs.append(mark.x)
+        self.ys.append(mark.y)
+        if self._grid is not None:
+            self._grid.setdefault(self._get_cell(mark.x, mark.y), []).append(len(self.xs) - 1)
+
+    def pop(self, position: int = -1):
+        if position < 0:
+            position += len(self.xs)
+        if position == len(self.xs) - 1 and self._grid is not None:
+            self._grid[self._get_cell(self.xs[position], self.ys[position])].remove(position)
+        else:
+            self._grid = None  # positions after the removed mark have shifted
+        del self.xs[position]
+        del self.ys[position]
+
+    def move(self, position: int, x: int, y: int):
+        if self._grid is not None:
+            self._grid[self._get_cell(self.xs[position], self.ys[position])].remove(position)
+            self._grid.setdefault(self._get_cell(x, y), []).append(position)
+        self.xs[position] = x
+        self.ys[position] = y
+
+    def clear(self):
+        del self.xs[:]
+        del self.ys[:]
+        self._grid = None
+
+    def find(self, x: int, y: int, radius: Optional[int] = None) -> Optional[int]:
+        """ Position of the topmost mark whose center is within radius of (x,y) """
+        radius = config.mark_circle_radius if radius is None else radius
+        found = None
+        for position in self._get_near(x - radius, y - radius, x + radius, y + radius):
+            dx, dy = self.xs[position] - x, self.ys[position] - y
+            if dx * dx + dy * dy <= radius * radius and (found is None or position > found):
+                found = position
+        return found
+
+    def overlapping(self, box: Tuple[int, int, int, int]) -> List[ImageMark]:
+        """ Marks whose bounding box may overlap the box, in drawing order """
+        margin = self._get_grid_cell_size()  # no mark reaches further than one cell from its center
+        positions = sorted(self._get_near(box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin))
+        return [self.get(position) for position in positions]
+
+    def _get_near(self, x1: int, y1: int, x2: int, y2: int) -> Iterator[int]:
+        """ Positions of the marks centered in the grid cells touching (x1,y1,x2,y2) """
+        grid = self._get_grid()
+        cx1, cy1 = self._get_cell(x1, y1)
+        cx2, cy2 = self._get_cell(x2, y2)
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                yield from grid.get((cx, cy), ())
+
+    def _get_grid_cell_size(self) -> int:
+        # a circle plus some room for numbers wider than it
+        return 2 * config.mark_circle_radius + 16
+
+    def _get_cell(self, x: int, y: int) -> Tuple[int, int]:
+        return x // self._cell_size, y // self._cell_size
+
+    def _get_grid(self) -> Dict[Tuple[int, int], List[int]]:
+        if self._grid is None or self._cell_size != self._get_grid_cell_size():
+            self._cell_size = self._get_grid_cell_size()
+            self._grid = {}
+            for position, (x, y) in enumerate(zip(self.xs, self.ys)):
+                self._grid.setdefault(self._get_cell(x, y), []).append(position)
+        return self._grid
@@ -1,10 +1,16 @@
 import os
-from typing import Optional, List
+from functools import partial
+from typing import Optional, Tuple
 
 from PIL import Image
 from PIL.Image import Resampling
 
-from models import ImageMark
+from config import config
+from instrumentation import tracer
+from models import ImageMark, MarkStore
+from models.image_cache import image_cache
+from models.raster_cache import raster_cache
+from models.tiled_image import TiledImage
 
 
 class MarkNotOnImageException(Exception):
@@ -13,16 +19,58 @@ class MarkNotOnImageException(Exception):
 
 class MarkedImage:
 
-    def __init__(self, file_path: str, resize_height: int = None, resize_width: int = None):
+    # reduce() fails on 1, P and 16 bit images, and would average the indices of PA images
+    REDUCIBLE_MODES = ('L', 'LA', 'La', 'RGB', 'RGBA', 'RGBa', 'RGBX', 'CMYK', 'YCbCr', 'LAB', 'HSV', 'I', 'F')
+
+    def __init__(
+            self, file_path: str, resize_height: int = None, resize_width: int = None,
+            source_size: Optional[Tuple[int, int]] = None, file_name: str = None):
         self.file_path = file_path
-        self.file_name = os.path.basename(file_path)
+        self.file_name = file_name or os.path.basename(file_path)  # path relative to the input folder
         self.resize_height = resize_height
         self.resize_width = resize_width
-        self.mark_list: List[Optional[ImageMark]] = []
+        self.mark_list = MarkStore()
         self.image_instance: Optional[Image] = None
-        self.open()
-        self.size = self.image_instance.size
-        self.close()
+        self.source_size = source_size  # size of the file on disk, read from the header when first needed
+        self._size: Optional[Tuple[int, int]] = None
+        self._large: Optional[bool] = None
+        self._tiled: Optional[TiledImage] = None
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """ Size of the resized image, pixels are decoded only when a render needs them """
+        if self._size is None:
+            if self.image_instance:
+                self._size = self.image_instance.size
+            else:
+                if self.is_large:
+                    return self.open_tiled().size
+                if not self.source_size:
+                    with Image.open(self.file_path) as temp_image:  # reads the header only
+                        self.source_size = temp_image.size
+                self._size = self.get_resized_size(*self.source_size)
+        return self._size
+
+    @property
+    def is_large(self) -> bool:
+        """ Tiled TIFFs of at least config.large_image_pixels are shown and saved tile by tile, not resized """
+        if self._large is None:
+            large = False
+            too_small = self.source_size and self.source_size[0] * self.source_size[1] < config.large_image_pixels
+            if config.large_images and not too_small and self.file_path.lower().endswith(('.tif', '.tiff')):
+                tiled = TiledImage.open_if_tiled(self.file_path, cache_bytes=0)
+                if tiled:
+                    with tiled:
+                        large = tiled.size[0] * tiled.size[1] >= config.large_image_pixels
+            self._large = large
+        return self._large
+
+    def open_tiled(self) -> TiledImage:
+        """ Tile reader of a large image, its tiles are decoded as the view needs them """
+        if not self._tiled:
+            self._tiled = TiledImage(self.file_path, cache_bytes=config.large_image_cache * 1024 * 1024)
+            self._size = self._tiled.size
+        return self._tiled
 
     def is_on_image(self, x: int, y: int) -> bool:
         return (0 <= x <= self.size[0]) and (0 <= y <= self.size[1])
@@ -33,9 +81,20 @@ class MarkedImage:
         self.mark_list.append(mark)
 
     def remove_mark(self, position: int):
+        """ Marks after the position move down by one number """
         if self.mark_list and (self.mark_count > position >= 0):
             self.mark_list.pop(position)
 
+    def move_mark(self, position: int, x: int, y: int):
+        if not self.is_on_image(x, y):
+            raise MarkNotOnImageException(f'Mark coords is {x, y}, however image size is {self.size}')
+        if self.mark_count > position >= 0:
+            self.mark_list.move(position, x, y)
+
+    def find_mark(self, x: int, y: int) -> Optional[int]:
+        """ Position of the topmost mark under (x,y) """
+        return self.mark_list.find(x, y)
+
     def remove_last_mark(self):
         if self.mark_count > 0:
             return self.remove_mark(self.mark_count - 1)
@@ -47,27 +106,83 @@ class MarkedImage:
     def mark_count(self):
         return len(self.mark_list)
 
+    @tracer.traced('MarkedImage.open')
     def open(self):
+        """ Pixels are shared through the image cache, so the returned image must not be modified in place """
         if not self.image_instance:
-            temp_image = Image.open(self.file_path)
-            if self.resize_width and self.resize_height:
-                width, height = temp_image.size
-                if width > height:
-                    scaling_factor = self.resize_width / width
-                    width = self.resize_width
-                    height = int(height * scaling_factor)
-                else:
-                    scaling_factor = self.resize_height / height
-                    height = self.resize_height
-                    width = int(width * scaling_factor)
-                temp_image = temp_image.resize((width, height), Resampling.LANCZOS)
-            self.image_instance = temp_image
+            self.image_instance = self.preload()
         return self.image_instance
 
+    def preload(self) -> Image:
+        """ Decode into the image cache without keeping a reference, safe to call from worker threads """
+        cache_key = self.get_cache_key()
+        return image_cache.get_or_load(cache_key, partial(self.load, cache_key))
+
+    def load(self, cache_key: Tuple) -> Image:
+        """ Resized pixels mapped from the raster cache, or decoded and stored there. RGB comes back as RGBX """
+        if not config.raster_cache:
+            return self.decode()
+        image = raster_cache.get(cache_key)
+        if image is None:
+            image = self.decode()
+            raster_cache.put(cache_key, image)
+        return image
+
+    @tracer.traced('MarkedImage.decode')
+    def decode(self) -> Image:
+        """ Decode and resize the file, bypassing the cache """
+        tracer.count('decodes')
+        temp_image = Image.open(self.file_path)
+        self.source_size = temp_image.size
+        if self.resize_width and self.resize_height:
+            tracer.count('resizes')
+            size = self.get_resized_size(*temp_image.size)
+            reduced_image = self.reduce(temp_image, size) if config.fast_decode else temp_image
+            resized_image = reduced_image.resize(size, Resampling.LANCZOS)
+            temp_image.close()
+            return resized_image
+        temp_image.load()
+        return temp_image
+
+    @classmethod
+    def reduce(cls, image: Image, size: Tuple[int, int]) -> Image:
+        """
+        Cheap downscale towards size, leaving a reducing gap for the final LANCZOS step to keep the quality.
+        JPEG is scaled while decoding (DCT scaling), then an integer box reduction takes what's left.
+        """
+        gap = config.reducing_gap
+        image.draft(None, (int(size[0] * gap), int(size[1] * gap)))  # no-op for formats other than JPEG
+        factor = int(min(image.width / size[0], image.height / size[1]) / gap)
+        if factor > 1 and image.mode in cls.REDUCIBLE_MODES:
+            return image.reduce(factor)
+        return image
+
+    def get_cache_key(self) -> Tuple:
+        """ Changes with the file and with every setting that changes the decoded pixels """
+        stat = os.stat(self.file_path)
+        return (
+            os.path.abspath(self.file_path), stat.st_mtime_ns, stat.st_size, self.resize_width, self.resize_height,
+            config.fast_decode, config.reducing_gap)
+
+    def get_resized_size(self, width: int, height: int) -> Tuple[int, int]:
+        """ Size of the image after the resize applied in open() """
+        if not (self.resize_width and self.resize_height):
+            return width, height
+        if width > height:
+            scaling_factor = self.resize_width / width
+            width = self.resize_width
+            height = int(height * scaling_factor)
+        else:
+            scaling_factor = self.resize_height / height
+            height = self.resize_height
+            width = int(width * scaling_factor)
+        return width, height
+
     def close(self):
-        if self.image_instance:
-            self.image_instance.close()
-            self.image_instance = None
+        # The pixels stay in the image cache and are released by its eviction
+        self.image_instance = None
+        if self._tiled:
+            self._tiled.close()
 
     def __del__(self):
         self.close()
@@ -0,0 +1,126 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from typing import Hashable, Optional
+
+from PIL import Image
+
+from config import SizeSetting, config
+from instrumentation import tracer
+
+
+def copy_image(image: Image.Image) -> Image.Image:
+    """ Writable copy of an image, rasters mapped as RGBX are copied back to RGB """
+    return image.convert('RGB') if image.mode == 'RGBX' else image.copy()
+
+
+class RasterCache:
+    """
+    Resized rasters kept on disk between sessions, one raw file per image with a small header.
+    Files are memory-mapped on load and the image is made over the mapping without copying the pixels.
+    RGB is stored as RGBX, the modes PIL can map directly have 1 or 4 bytes per pixel.
+    Size is capped by evicting the files least recently used, each load touches the mtime of its file.
+    """
+
+    MAGIC = b'BMRASTR1'
+    HEADER = struct.Struct('<8s8sII20s')  # magic, mode, width, height, sha1 of the key
+    HEADER_SIZE = 64  # header is padded, so the pixels start aligned
+    STORED_MODES = {'L': 'L', 'RGB': 'RGBX', 'RGBA': 'RGBA'}
+    EVICT_TO = 0.9  # of the cap, so the folder is listed and sorted once per many puts, not on every one over it
+    max_bytes = SizeSetting('raster_cache_size')
+
+    def __init__(self, folder: str, max_bytes: Optional[int] = None):
+        self.folder = folder
+        self.max_bytes = max_bytes  # None takes config.raster_cache_size
+        self._current_bytes: Optional[int] = None  # size of the folder, measured on the first write
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_digest(key: Hashable) -> bytes:
+        return hashlib.sha1(repr(key).encode('utf-8')).digest()
+
+    def get_path(self, digest: bytes) -> str:
+        return f'{self.folder}/{digest.hex()}.raw'
+
+    @tracer.traced('RasterCache.get')
+    def get(self, key: Hashable) -> Optional[Image.Image]:
+        """ Image mapped from the cached raster, None if there is no valid raster for the key """
+        digest = self.get_digest(key)
+        path = self.get_path(digest)
+        try:
+            with open(path, 'rb') as _f:
+                mapping = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, mode, width, height, key_digest = self.HEADER.unpack_from(mapping)
+            mode = mode.rstrip(b'\0').decode('ascii')
+            if (magic != self.MAGIC or key_digest != digest or mode not in self.STORED_MODES.values() or
+                    len(mapping) != self.HEADER_SIZE + width * height * len(mode)):
+                tracer.count('raster_cache_misses')
+                return None
+            os.utime(path)  # most recently used
+        except (OSError, ValueError, struct.error):
+            tracer.count('raster_cache_misses')
+            return None
+        tracer.count('raster_cache_hits')
+        pixels = memoryview(mapping)[self.HEADER_SIZE:]
+        return Image.frombuffer(mode, (width, height), pixels, 'raw', mode, 0, 1)
+
+    @tracer.traced('RasterCache.put')
+    def put(self, key: Hashable, image: Image.Image):
+        stored_mode = self.STORED_MODES.get(image.mode)
+        if not stored_mode:
+            return  # palette, 16 bit and other modes are decoded every time
+        digest = self.get_digest(key)
+        header = self.HEADER.pack(
+            self.MAGIC, stored_mode.encode('ascii'), image.width, image.height, digest).ljust(self.HEADER_SIZE, b'\0')
+        pixels = image.convert(stored_mode) if stored_mode != image.mode else image
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+            try:
+                with os.fdopen(fd, 'wb') as temp_file:
+                    temp_file.write(header)
+                    temp_file.write(pixels.tobytes())
+                os.replace(temp_path, self.get_path(digest))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            return  # a full or read-only disk only costs the cache
+        self.add_bytes(len(header) + image.width * image.height * len(stored_mode))
+
+    def add_bytes(self, added: int):
+        with self._lock:
+            if self._current_bytes is None:
+                self._current_bytes = sum(entry.stat().st_size for entry in self.scan())
+            else:
+                self._current_bytes += added
+            if self._current_bytes > self.max_bytes:
+                self._current_bytes = self.evict()
+
+    def scan(self):
+        try:
+            with os.scandir(self.folder) as entries:
+                return [entry for entry in entries if entry.name.endswith('.raw') and entry.is_file()]
+        except OSError:
+            return []
+
+    def evict(self) -> int:
+        """ Remove the least recently used files until the folder is down to EVICT_TO of the cap, returns the size """
+        entries = sorted(((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in self.scan()))
+        total = sum(size for _, size, _ in entries)
+        low_water = self.max_bytes * self.EVICT_TO
+        for _, size, path in entries:
+            if total <= low_water:
+                break
+            try:
+                os.remove(path)  # mappings already made stay valid on POSIX
+                total -= size
+            except OSError:
+                pass  # still mapped on Windows, it goes on a later eviction
+        return total
+
+
+raster_cache = RasterCache(f'{config.conf_path}/raster_cache')
@@ -0,0 +1,457 @@
+import io
+import math
+import struct
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+from instrumentation import tracer
+from models import ImageMark
+
+
+class TiffError(OSError):
+    pass
+
+
+# TIFF tags used for reading and writing tiled images
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+SAMPLES_PER_PIXEL = 277
+PLANAR_CONFIG = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+EXTRA_SAMPLES = 338
+JPEG_TABLES = 347
+
+# TIFF field type -> struct format of one value, rationals are read as pairs of integers
+FIELD_TYPES = {
+    1: 'B', 2: 'B', 3: 'H', 4: 'I', 5: 'I', 6: 'b', 7: 'B', 8: 'h', 9: 'i', 10: 'i', 11: 'f', 12: 'd',
+    16: 'Q', 17: 'q', 18: 'Q'}
+
+COMPRESSION_NONE = 1
+COMPRESSION_JPEG = 7
+COMPRESSION_DEFLATE = (8, 32946)
+
+
+class TiffLevel:
+    """ One resolution of a tiled TIFF, with where to find each of its tiles """
+
+    __slots__ = (
+        'width', 'height', 'tile_width', 'tile_height', 'offsets', 'byte_counts', 'compression', 'photometric',
+        'predictor', 'mode', 'jpeg_tables', 'downsample')
+
+    def __init__(self, width: int, height: int, tile_width: int, tile_height: int, offsets: array,
+                 byte_counts: array, compression: int, photometric: int, predictor: int, mode: str,
+                 jpeg_tables: Optional[bytes]):
+        self.width = width
+        self.height = height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.offsets = offsets
+        self.byte_counts = byte_counts
+        self.compression = compression
+        self.photometric = photometric
+        self.predictor = predictor
+        self.mode = mode
+        self.jpeg_tables = jpeg_tables
+        self.downsample = (1.0, 1.0)  # size of the full resolution level over the size of this one
+
+    @property
+    def tiles_across(self) -> int:
+        return math.ceil(self.width / self.tile_width)
+
+    @property
+    def tiles_down(self) -> int:
+        return math.ceil(self.height / self.tile_height)
+
+
+class TiledImage:
+    """
+    Tiled TIFF read one tile at a time, never decoded as a whole. Reduced resolution pages of the file
+    are used as pyramid levels. Decoded tiles are kept in an LRU cache bounded by the size of their pixels.
+    Supports 8 bit grayscale, RGB and RGBA tiles, uncompressed, deflate (with or without the horizontal
+    predictor) or JPEG compressed, in classic TIFF and BigTIFF.
+    """
+
+    def __init__(self, file_path: str, cache_bytes: int = 64 * 1024 * 1024):
+        self.file_path = file_path
+        self.cache_bytes = cache_bytes
+        self.levels: List[TiffLevel] = []
+        self._fp: Optional[BinaryIO] = open(file_path, 'rb')
+        self._tiles: 'OrderedDict[Tuple[int, int, int], Image.Image]' = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        try:
+            self._read_levels()
+        except (struct.error, ValueError) as e:
+            self.close()
+            raise TiffError(f'Broken TIFF file {file_path}: {e}')
+        except BaseException:
+            self.close()
+            raise
+
+    @classmethod
+    def open_if_tiled(cls, file_path: str, cache_bytes: int = 64 * 1024 * 1024) -> Optional['TiledImage']:
+        """ None for files that aren't tiled TIFFs this reader supports """
+        try:
+            return cls(file_path, cache_bytes=cache_bytes)
+        except OSError:  # TiffError included
+            return None
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.levels[0].width, self.levels[0].height
+
+    @property
+    def mode(self) -> str:
+        return self.levels[0].mode
+
+    def _read_levels(self):
+        fp = self._fp
+        header = fp.read(16)
+        byte_order = {b'II': '<', b'MM': '>'}.get(header[:2])
+        if not byte_order:
+            raise TiffError('Not a TIFF file')
+        version, = struct.unpack(f'{byte_order}H', header[2:4])
+        if version == 42:
+            offset, = struct.unpack(f'{byte_order}I', header[4:8])
+            count_format, entry_size, offset_format = 'H', 12, 'I'
+        elif version == 43:
+            offset, = struct.unpack(f'{byte_order}Q', header[8:16])
+            count_format, entry_size, offset_format = 'Q', 20, 'Q'
+        else:
+            raise TiffError('Not a TIFF file')
+        self._byte_order = byte_order
+        self._offset_format = offset_format
+
+        seen = set()
+        while offset and offset not in seen:
+            seen.add(offset)
+            fp.seek(offset)
+            count, = struct.unpack(f'{byte_order}{count_format}', fp.read(struct.calcsize(count_format)))
+            data = fp.read(count * entry_size + struct.calcsize(offset_format))
+            tags = {}
+            for i in range(count):
+                entry = data[i * entry_size:(i + 1) * entry_size]
+                if entry_size == 20:
+                    tag, field_type, value_count = struct.unpack(f'{byte_order}HHQ', entry[:12])
+                    value = entry[12:]
+                else:
+                    tag, field_type, value_count = struct.unpack(f'{byte_order}HHI', entry[:8])
+                    value = entry[8:]
+                tags[tag] = (field_type, value_count, value)
+            offset, = struct.unpack(f'{byte_order}{offset_format}', data[count * entry_size:])
+            level = self._make_level(tags)
+            if not self.levels:
+                if not level:
+                    raise TiffError('First page is not a supported tiled image')
+                self.levels.append(level)
+            elif level and level.mode == self.mode and level.width < self.levels[-1].width:
+                # Reduced resolution copies of the first page, other pages are separate images
+                ratio = (self.levels[0].width / level.width, self.levels[0].height / level.height)
+                if abs(ratio[0] - ratio[1]) / ratio[0] < 0.02:
+                    level.downsample = ratio
+                    self.levels.append(level)
+
+    def _read_tag(self, tags: Dict, tag: int, default=None):
+        if tag not in tags:
+            return default
+        field_type, count, value = tags[tag]
+        value_format = FIELD_TYPES.get(field_type)
+        if not value_format:
+            return default
+        if field_type in (5, 10):
+            count *= 2
+        size = struct.calcsize(value_format) * count
+        if size <= len(value):
+            raw = value[:size]
+        else:
+            offset, = struct.unpack(f'{self._byte_order}{self._offset_format}', value)
+            self._fp.seek(offset)
+            raw = self._fp.read(size)
+        if field_type == 7:
+            return raw
+        return struct.unpack(f'{self._byte_order}{count}{value_format}', raw)
+
+    def _make_level(self, tags: Dict) -> Optional[TiffLevel]:
+        if TILE_WIDTH not in tags or TILE_OFFSETS not in tags:
+            return None  # stripped images are left to PIL
+        samples = self._read_tag(tags, SAMPLES_PER_PIXEL, (1,))[0]
+        photometric = self._read_tag(tags, PHOTOMETRIC, (None,))[0]
+        compression = self._read_tag(tags, COMPRESSION, (COMPRESSION_NONE,))[0]
+        predictor = self._read_tag(tags, PREDICTOR, (1,))[0]
+        if set(self._read_tag(tags, BITS_PER_SAMPLE, (1,))) != {8} or self._read_tag(tags, PLANAR_CONFIG, (1,))[0] != 1:
+            return None
+        match samples, photometric:
+            case 1, 1:
+                mode = 'L'
+            case 3, 2:
+                mode = 'RGB'
+            case 3, 6 if compression == COMPRESSION_JPEG:
+                mode = 'RGB'  # YCbCr is converted by the JPEG decoder
+            case 4, 2:
+                mode = 'RGBA'
+            case _:
+                return None
+        if compression not in (COMPRESSION_NONE, COMPRESSION_JPEG, *COMPRESSION_DEFLATE) or predictor not in (1, 2):
+            return None
+        if compression == COMPRESSION_JPEG and (mode == 'RGBA' or predictor != 1):
+            return None
+        offset_type = 'Q' if tags[TILE_OFFSETS][0] in (16, 18) else 'I'
+        return TiffLevel(
+            width=self._read_tag(tags, IMAGE_WIDTH)[0], height=self._read_tag(tags, IMAGE_LENGTH)[0],
+            tile_width=self._read_tag(tags, TILE_WIDTH)[0], tile_height=self._read_tag(tags, TILE_LENGTH)[0],
+            offsets=array(offset_type, self._read_tag(tags, TILE_OFFSETS)),
+            byte_counts=array(offset_type, self._read_tag(tags, TILE_BYTE_COUNTS)),
+            compression=compression, photometric=photometric, predictor=predictor, mode=mode,
+            jpeg_tables=self._read_tag(tags, JPEG_TABLES))
+
+    def read_tile(self, level_index: int, tx: int, ty: int) -> Image.Image:
+        """ Decoded tile, shared through the cache, so it must not be modified in place """
+        key = (level_index, tx, ty)
+        level = self.levels[level_index]
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return tile
+            index = ty * level.tiles_across + tx
+            if index >= len(level.offsets) or not level.byte_counts[index]:
+                data = None  # sparse files leave out empty tiles
+            else:
+                if self._fp is None:
+                    self._fp = open(self.file_path, 'rb')
+                self._fp.seek(level.offsets[index])
+                data = self._fp.read(level.byte_counts[index])
+        try:
+            tile = self.decode_tile(level, data)
+        except (zlib.error, ValueError, SyntaxError, EOFError, Image.DecompressionBombError) as e:
+            # Raised by the decoders on corrupt tile data, callers expect the OSError a broken file gives
+            raise TiffError(f'Broken tile {key} in {self.file_path}: {e}') from e
+        tile_bytes = tile.width * tile.height * len(tile.getbands())
+        with self._lock:
+            self._tiles[key] = tile
+            self._current_bytes += tile_bytes
+            while self._current_bytes > self.cache_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self._current_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+        return tile
+
+    @staticmethod
+    @tracer.traced('TiledImage.decode_tile')
+    def decode_tile(level: TiffLevel, data: Optional[bytes]) -> Image.Image:
+        size = (level.tile_width, level.tile_height)  # edge tiles are stored padded to the full size
+        if data is None:
+            return Image.new(level.mode, size)
+        if level.compression == COMPRESSION_JPEG:
+            if level.jpeg_tables:
+                data = level.jpeg_tables[:-2] + data[2:]  # tables without their EOI, tile without its SOI
+            tile = Image.open(io.BytesIO(data))
+            if level.photometric == 2 and tile.mode == 'RGB':
+                # Stored as RGB, not YCbCr, which the decoder would assume without an Adobe marker
+                tile.tile = [(name, extents, offset, ('RGB', 'RGB')) for name, extents, offset, _ in tile.tile]
+            tile.load()
+            return tile if tile.mode == level.mode else tile.convert(level.mode)
+        if level.compression in COMPRESSION_DEFLATE:
+            data = zlib.decompress(data)
+        bands = len(level.mode)
+        if level.predictor == 2:
+            data = TiledImage.undo_predictor(data, level.tile_width * bands, bands)
+        return Image.frombytes(level.mode, size, data[:size[0] * size[1] * bands])
+
+    @staticmethod
+    def undo_predictor(data: bytes, row_size: int, bands: int) -> bytes:
+        """ Horizontal differencing stores each sample as the difference to the one on its left """
+        pixels = bytearray(data)
+        for start in range(0, len(pixels) - row_size + 1, row_size):
+            for band in range(bands):
+                samples = slice(start + band, start + row_size, bands)
+                pixels[samples] = bytes(accumulate(pixels[samples], lambda a, b: (a + b) & 255))
+        return bytes(pixels)
+
+    def get_region(
+            self, box: Tuple[float, float, float, float], size: Tuple[int, int],
+            resample: int = Image.BILINEAR) -> Image.Image:
+        """
+        Box of the full resolution image resized to size. Read from the coarsest level that still has enough
+        pixels, each tile is scaled on its own, so memory depends only on the output size.
+        """
+        reduction = min((box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1])
+        level_index = 0
+        for i, level in enumerate(self.levels):
+            if level.downsample[0] <= reduction * 1.01:
+                level_index = i
+        level = self.levels[level_index]
+        dx, dy = level.downsample
+        lx1, ly1, lx2, ly2 = box[0] / dx, box[1] / dy, min(box[2] / dx, level.width), min(box[3] / dy, level.height)
+        kx, ky = size[0] / (lx2 - lx1), size[1] / (ly2 - ly1)
+        region = Image.new(level.mode, size)
+        tw, th = level.tile_width, level.tile_height
+        for ty in range(int(ly1 // th), min(math.ceil(ly2 / th), level.tiles_down)):
+            for tx in range(int(lx1 // tw), min(math.ceil(lx2 / tw), level.tiles_across)):
+                # Part of the tile inside the box, in level pixels
+                px1, py1 = max(lx1, tx * tw), max(ly1, ty * th)
+                px2, py2 = min(lx2, (tx + 1) * tw), min(ly2, (ty + 1) * th)
+                dest = (round((px1 - lx1) * kx), round((py1 - ly1) * ky),
+                        round((px2 - lx1) * kx), round((py2 - ly1) * ky))
+                if dest[2] <= dest[0] or dest[3] <= dest[1]:
+                    continue
+                tile = self.read_tile(level_index, tx, ty)
+                tile_box = (px1 - tx * tw, py1 - ty * th, px2 - tx * tw, py2 - ty * th)
+                dest_size = (dest[2] - dest[0], dest[3] - dest[1])
+                if dest_size == (tile_box[2] - tile_box[0], tile_box[3] - tile_box[1]) and \
+                        all(float(v).is_integer() for v in tile_box):
+                    part = tile.crop(tuple(map(int, tile_box)))
+                else:
+                    part = tile.resize(dest_size, resample, box=tile_box)
+                region.paste(part, dest[:2])
+        return region
+
+    def close(self):
+        with self._lock:
+            if self._fp:
+                self._fp.close()
+                self._fp = None  # reopened by the next read, the canvas may still redraw the image
+            self._tiles.clear()
+            self._current_bytes = 0
+
+    def __enter__(self) -> 'TiledImage':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TiledTiffWriter:
+    """ Writes a deflate compressed tiled TIFF tile by tile, only the tile offsets are kept until the end """
+
+    def __init__(self, fp: BinaryIO, size: Tuple[int, int], mode: str, tile_size: Tuple[int, int] = (256, 256)):
+        self.fp = fp
+        self.size = size
+        self.mode = mode
+        self.tile_size = tile_size
+        # Offsets of classic TIFF are 32 bit, BigTIFF is used when the output could outgrow them
+        self.big = size[0] * size[1] * len(mode) > 2 ** 32 - 2 ** 26
+        self.offsets = array('Q')
+        self.byte_counts = array('Q')
+        self.start = fp.tell()
+        if self.big:
+            fp.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        else:
+            fp.write(b'II' + struct.pack('<HI', 42, 0))
+
+    def write_tile(self, tile: Image.Image):
+        """ Tiles go left to right, top to bottom, each one the full tile size """
+        data = zlib.compress(tile.tobytes(), 6)
+        self.offsets.append(self.fp.tell() - self.start)
+        self.byte_counts.append(len(data))
+        self.fp.write(data)
+
+    def close(self):
+        """ Write the directory of the image and point the header to it """
+        fp = self.fp
+        if (fp.tell() - self.start) % 2:
+            fp.write(b'\0')  # directories start on a word boundary
+        ifd_offset = fp.tell() - self.start
+        long_type = 16 if self.big else 4
+        entries = [
+            (IMAGE_WIDTH, 4, [self.size[0]]),
+            (IMAGE_LENGTH, 4, [self.size[1]]),
+            (BITS_PER_SAMPLE, 3, [8] * len(self.mode)),
+            (COMPRESSION, 3, [COMPRESSION_DEFLATE[0]]),
+            (PHOTOMETRIC, 3, [1 if self.mode == 'L' else 2]),
+            (SAMPLES_PER_PIXEL, 3, [len(self.mode)]),
+            (PLANAR_CONFIG, 3, [1]),
+            (TILE_WIDTH, 4, [self.tile_size[0]]),
+            (TILE_LENGTH, 4, [self.tile_size[1]]),
+            (TILE_OFFSETS, long_type, self.offsets),
+            (TILE_BYTE_COUNTS, long_type, self.byte_counts)]
+        if self.mode == 'RGBA':
+            entries.append((EXTRA_SAMPLES, 3, [2]))  # unassociated alpha
+        fp.write(self.pack_ifd(entries, ifd_offset))
+        end = fp.tell()
+        fp.seek(self.start + (8 if self.big else 4))
+        fp.write(struct.pack('<Q' if self.big else '<I', ifd_offset))
+        fp.seek(end)
+
+    def pack_ifd(self, entries: List[Tuple[int, int, Iterable[int]]], ifd_offset: int) -> bytes:
+        if self.big:
+            count_format, entry_format, offset_format, inline_size = '<Q', '<HHQ', '<Q', 8
+        else:
+            count_format, entry_format, offset_format, inline_size = '<H', '<HHI', '<I', 4
+        entry_size = struct.calcsize(entry_format) + inline_size
+        data_offset = ifd_offset + struct.calcsize(count_format) + len(entries) * entry_size + \
+            struct.calcsize(offset_format)
+        ifd = bytearray(struct.pack(count_format, len(entries)))
+        extra = bytearray()  # values that don't fit into their entry
+        for tag, field_type, values in entries:
+            values = list(values)
+            raw = struct.pack(f'<{len(values)}{FIELD_TYPES[field_type]}', *values)
+            ifd += struct.pack(entry_format, tag, field_type, len(values))
+            if len(raw) <= inline_size:
+                ifd += raw.ljust(inline_size, b'\0')
+            else:
+                ifd += struct.pack(offset_format, data_offset + len(extra))
+                extra += raw
+                if len(extra) % 2:
+                    extra += b'\0'
+        ifd += struct.pack(offset_format, 0)  # no next directory
+        return bytes(ifd + extra)
+
+
+class TiledRender:
+    """
+    Marked copy of a tiled image that is made while it's saved: each tile is read, gets the marks over it
+    and is written out before the next one. Saved as a tiled TIFF.
+    """
+
+    def __init__(self, file_path: str, marks: Iterable[ImageMark], cache_bytes: int = 16 * 1024 * 1024):
+        self.file_path = file_path
+        self.marks = list(marks)
+        self.cache_bytes = cache_bytes
+
+    @tracer.traced('TiledRender.save')
+    def save(self, fp: BinaryIO, format: Optional[str] = None):
+        """ Same call as Image.save with a file object, so it can be handed to save_atomically """
+        if format not in (None, 'TIFF'):
+            raise ValueError(f'Large images can only be saved as TIFF, not {format}')
+        with TiledImage(self.file_path, cache_bytes=self.cache_bytes) as source:
+            level = source.levels[0]
+            # Tiles of the source are reused when they are valid output tiles, whose sides are multiples of 16
+            tile_size = (level.tile_width, level.tile_height) \
+                if not (level.tile_width % 16 or level.tile_height % 16) else (256, 256)
+            tw, th = tile_size
+            width, height = source.size
+            tiles_across, tiles_down = math.ceil(width / tw), math.ceil(height / th)
+            marks_by_tile: Dict[Tuple[int, int], List[ImageMark]] = {}
+            for mark in self.marks:
+                left, upper, right, lower = mark.get_bounding_box()
+                for ty in range(max(0, upper // th), min(tiles_down, (lower - 1) // th + 1)):
+                    for tx in range(max(0, left // tw), min(tiles_across, (right - 1) // tw + 1)):
+                        marks_by_tile.setdefault((tx, ty), []).append(mark)
+
+            writer = TiledTiffWriter(fp, source.size, source.mode, tile_size)
+            for ty in range(tiles_down):
+                for tx in range(tiles_across):
+                    box = (tx * tw, ty * th, min((tx + 1) * tw, width), min((ty + 1) * th, height))
+                    tile = source.get_region(box, (box[2] - box[0], box[3] - box[1]))
+                    if tile.size != tile_size:
+                        padded = Image.new(tile.mode, tile_size)
+                        padded.paste(tile, (0, 0))
+                        tile = padded
+                    for mark in marks_by_tile.get((tx, ty), ()):
+                        mark.draw(tile, offset=box[:2])
+                    writer.write_tile(tile)
+            writer.close()
@@ -1,10 +1,13 @@
+import os
 import tkinter as tk
 from functools import partial
-from tkinter import ttk
+from tkinter import messagebox, ttk
+from typing import Optional, Tuple
 
 from config import config
 from controllers import ImageMarkingFileManager, ImageMarkingController
-from views.widgets import ZoomCanvas
+from instrumentation import tracer
+from views.widgets import Filmstrip, ZoomCanvas
 
 
 class MainWindow(tk.Tk):
@@ -13,6 +16,12 @@ class MainWindow(tk.Tk):
         super().__init__('MainWindow', *args, **kwargs)
 
         self.file_manager = ImageMarkingFileManager()
+        self.index_poll_job = None
+        self.save_poll_job = None
+        self.thumbnail_poll_job = None
+        self.rescan_job = None
+        self.rescan_poll_job = None
+        self.picked_mark: Optional[int] = None  # position of the mark being moved
 
         self.title(config.app_title)
         self.minsize(config.window_min_size_x, config.window_min_size_y)
@@ -36,6 +45,10 @@ class MainWindow(tk.Tk):
             self.menu_block_upper, text='Select output folder',
             command=self.file_manager.select_output_folder
         ).grid(row=1, column=0, sticky='news', pady=10, padx=10)
+        ttk.Button(
+            self.menu_block_upper, text='Rescan input folder',
+            command=self.rescan_folder
+        ).grid(row=2, column=0, sticky='news', pady=10, padx=10)
         ttk.Button(
             self.menu_block_lower, text='Save and go next',
             command=partial(self.next_file, save_current=True, index_modifier=1)
@@ -74,7 +87,7 @@ class MainWindow(tk.Tk):
         self.canvas_block.update()  # wait till canvas is created
 
         # Bind key actions
-        self.canvas_block.bind('<Configure>', lambda event: self.canvas_block.show_image())  # canvas is resized
+        self.canvas_block.bind('<Configure>', lambda event: self.canvas_block.request_redraw())  # canvas is resized
 
         self.canvas_block.bind('<MouseWheel>', self.canvas_block.wheel)  # zoom for Windows and macOS, but not Linux
         self.canvas_block.bind('<Button-5>', self.canvas_block.wheel)  # zoom for Linux, wheel scroll down
@@ -84,12 +97,30 @@ class MainWindow(tk.Tk):
         self.canvas_block.bind('<B1-Motion>', self.canvas_block.move_to)  # move canvas to the new position
 
         self.canvas_block.bind('<Double-Button-1>', self.place_mark)  # place a mark under the cursor
+        self.canvas_block.bind('<Button-3>', self.remove_mark_under_cursor)  # remove any mark, later ones renumber
+        self.canvas_block.bind('<Shift-ButtonPress-1>', self.pick_mark)  # shift + drag moves a mark
+        self.canvas_block.bind('<Shift-B1-Motion>', self.drag_mark)  # outline where it goes, instead of panning
+        self.canvas_block.bind('<Shift-ButtonRelease-1>', self.drop_mark)
+        self.canvas_block.bind('<ButtonRelease-1>', self.cancel_mark_drag)  # shift was let go before the button
         self.bind('<BackSpace>', lambda event: self.remove_mark(clear_all=False))
         self.bind('<Shift-BackSpace>', lambda event: self.remove_mark(clear_all=True))
 
+        # Thumbnails of the folder, click one to jump to it
+        self.filmstrip_frame = tk.Frame(self)
+        self.filmstrip: Optional[Filmstrip] = None
+        if config.filmstrip:
+            self.filmstrip = Filmstrip(
+                self.filmstrip_frame, thumbnail_size=config.thumbnail_size,
+                get_label=self.get_file_label,
+                on_select=self.jump_to_file,
+                on_request=self.request_thumbnails)
+            self.filmstrip.grid(row=0, column=0, sticky='ns')
+
         # status bar
         self.status_frame = tk.Frame(self)
         self.status = ttk.Label(self.status_frame, text="0 / 0")
+        self.status_saves = ttk.Label(self.status_frame, text='')
+        self.status_frame_time = ttk.Label(self.status_frame, text='')
         self.status_second = ttk.Label(self.status_frame, text='© by Hirugi, 2021')
 
         # Pack everything
@@ -101,39 +132,261 @@ class MainWindow(tk.Tk):
         self.image_frame.grid(row=1, column=1, sticky="nsew")
         self.image_frame.grid_rowconfigure(0, weight=1)
         self.image_frame.grid_columnconfigure(0, weight=1)
+        if self.filmstrip:
+            self.filmstrip_frame.grid(row=0, column=2, rowspan=2, sticky="ns")
+            self.filmstrip_frame.grid_rowconfigure(0, weight=1)
         self.status.pack(fill="both", expand=False, side='left', ipadx=10)
+        self.status_saves.pack(fill="both", expand=False, side='left', ipadx=10)
+        if tracer.enabled:
+            self.status_frame_time.pack(fill="both", expand=False, side='left', ipadx=10)
+            self.update_frame_time()
         self.status_second.pack(fill="both", expand=True)
-        self.status_frame.grid(row=2, column=0, columnspan=2, sticky="ew")
+        self.status_frame.grid(row=2, column=0, columnspan=3, sticky="ew")
+
+        self.protocol('WM_DELETE_WINDOW', self.close)
+        if config.rescan_interval:
+            self.rescan_job = self.after(config.rescan_interval * 1000, self.auto_rescan)
 
     def update_status(self):
-        self.status.configure(text=f'{self.file_manager.selected_file_index + 1} / {len(self.file_manager.files_list)}')
+        files_count = len(self.file_manager.files_list)
+        current = self.file_manager.selected_file_index + 1 if files_count else 0
+        scanning = ' …' if self.file_manager.is_indexing else ''
+        index_error = self.file_manager.index_error
+        if index_error:
+            scanning = f" — can't read the folder: {index_error.strerror or index_error}"
+        self.status.configure(text=f'{current} / {files_count}{scanning}')
+        if self.filmstrip:
+            self.filmstrip.set_count(files_count)
+            if files_count and self.filmstrip.selected != current - 1:
+                self.filmstrip.set_selected(current - 1)
+
+    def get_file_label(self, index: int) -> str:
+        """ Path of the file in the input folder, with the number of marks it had when last left """
+        files_list = self.file_manager.files_list
+        mark_count = files_list.mark_counts[index]
+        return f'{files_list[index]} ({mark_count})' if mark_count else files_list[index]
 
     def select_folder(self):
+        if self.index_poll_job:
+            self.after_cancel(self.index_poll_job)
+            self.index_poll_job = None
+        if self.rescan_poll_job:
+            self.after_cancel(self.rescan_poll_job)
+            self.rescan_poll_job = None
+        self.picked_mark = None
         self.file_manager.select_input_folder()
+        if self.filmstrip:
+            self.filmstrip.reset()
         current_file: ImageMarkingController = self.file_manager.get_current_file()
         if current_file:
-            self.canvas_block.load_image(current_file.render_image())
-            self.update_status()
+            self.show_file(current_file)
+        self.update_status()
+        if self.file_manager.is_indexing:
+            self.index_poll_job = self.after(config.index_poll_interval, self.poll_folder_index)
+
+    def poll_folder_index(self):
+        """ Pick up files found by the background indexer, shows the first one as soon as it arrives """
+        self.index_poll_job = None
+        had_files = bool(self.file_manager.files_list)
+        self.file_manager.poll_index()
+        if not had_files:
+            current_file: ImageMarkingController = self.file_manager.get_current_file()
+            if current_file:
+                self.show_file(current_file)
+        self.update_status()
+        if self.file_manager.is_indexing:
+            self.index_poll_job = self.after(config.index_poll_interval, self.poll_folder_index)
+
+    def rescan_folder(self):
+        """ Pick up new and removed files without reloading the folder, the current file and all marks are kept """
+        files_list = self.file_manager.files_list
+        previous_name = files_list[self.file_manager.selected_file_index] if files_list else None
+        added, removed = self.file_manager.rescan()
+        if self.file_manager.is_rescanning and not self.rescan_poll_job:
+            # Recursive folders are listed in the background, the changes are picked up when the listing is done
+            self.rescan_poll_job = self.after(config.index_poll_interval, self.poll_rescan)
+        if not (added or removed):
+            return
+        if self.filmstrip:
+            self.filmstrip.invalidate()  # indices have shifted
+        files_list = self.file_manager.files_list
+        current_name = files_list[self.file_manager.selected_file_index] if files_list else None
+        if current_name != previous_name:
+            current_file: ImageMarkingController = self.file_manager.get_current_file()
+            self.picked_mark = None
+            if current_file:
+                self.show_file(current_file)
+            else:
+                self.canvas_block.clear_marks()
+        self.update_status()
+
+    def poll_rescan(self):
+        self.rescan_poll_job = None
+        self.rescan_folder()
+
+    def auto_rescan(self):
+        self.rescan_job = None
+        self.rescan_folder()
+        self.rescan_job = self.after(config.rescan_interval * 1000, self.auto_rescan)
 
     def next_file(self, save_current: bool, index_modifier: int):
         new_file: ImageMarkingController = self.file_manager.get_next_file(
             save_current=save_current, index_modifier=index_modifier)
+        if save_current and not self.save_poll_job:
+            self.update_save_status()
         if new_file:
-            self.canvas_block.load_image(new_file.render_image())
+            self.show_file(new_file)
             self.update_status()
 
+    def jump_to_file(self, index: int):
+        new_file: ImageMarkingController = self.file_manager.jump_to_file(index)
+        if new_file:
+            self.show_file(new_file)
+            self.update_status()
+
+    def request_thumbnails(self, indices):
+        self.file_manager.request_thumbnails(indices)
+        if not self.thumbnail_poll_job:
+            self.thumbnail_poll_job = self.after(config.index_poll_interval, self.poll_thumbnails)
+
+    def poll_thumbnails(self):
+        """ Hand the thumbnails made in the background to the filmstrip, it makes the PhotoImages on the Tk thread """
+        self.thumbnail_poll_job = None
+        files_count = len(self.file_manager.files_list)
+        for index, file_path, thumbnail in self.file_manager.thumbnails.take_ready():
+            # Skip thumbnails requested for the previous folder
+            if index < files_count and self.file_manager.get_item_path(index) == file_path:
+                self.filmstrip.set_thumbnail(index, thumbnail)
+        if self.file_manager.thumbnails.pending:
+            self.thumbnail_poll_job = self.after(config.index_poll_interval, self.poll_thumbnails)
+
+    def update_save_status(self):
+        """ Show the number of saves still being written, polls until the save queue is empty """
+        self.save_poll_job = None
+        save_queue = self.file_manager.save_queue
+        errors = self.file_manager.take_save_errors()
+        if errors:
+            save_path, error = errors[-1]
+            self.status_saves.configure(text=f'Failed to save {os.path.basename(save_path)}: {error}')
+        elif save_queue.pending:
+            self.status_saves.configure(text=f'Saving {save_queue.pending}…')
+        elif not self.status_saves.cget('text').startswith('Failed'):
+            self.status_saves.configure(text='')
+        if save_queue.pending:
+            self.save_poll_job = self.after(200, self.update_save_status)
+
+    def update_frame_time(self):
+        """ Live readout of the latest canvas frame, shown while instrumentation is on """
+        frame_time = tracer.last_durations.get('show_image')
+        if frame_time is not None:
+            self.status_frame_time.configure(text=f'frame {frame_time:.1f} ms')
+        self.after(250, self.update_frame_time)
+
+    def close(self):
+        """ Write the pending saves (and the trace, when recording) before the window is destroyed """
+        if self.file_manager.save_queue.pending:
+            self.status_saves.configure(text=f'Saving {self.file_manager.save_queue.pending}…')
+            self.update_idletasks()
+        self.file_manager.close()
+        errors = self.file_manager.take_save_errors()
+        if errors:
+            messagebox.showerror(
+                config.app_title, 'Failed to save:\n' + '\n'.join(f'{path}: {error}' for path, error in errors),
+                parent=self)
+        if tracer.enabled:
+            tracer.export()
+        self.destroy()
+
+    @staticmethod
+    def uses_canvas_marks(file: ImageMarkingController) -> bool:
+        # Large images are never held whole in memory, their marks reach the pixels only when saved
+        return config.canvas_marks or file.image.is_large
+
+    def show_file(self, file: ImageMarkingController):
+        if file.image.is_large:
+            self.canvas_block.load_image(file.image.open_tiled())
+            self.sync_canvas_marks(file)
+        elif config.canvas_marks:
+            # Marks are canvas items on top of the unmarked image, pixels are only touched when saving
+            self.canvas_block.load_image(file.image.open())
+            self.sync_canvas_marks(file)
+        else:
+            self.canvas_block.load_image(file.get_working_image())
+
+    def sync_canvas_marks(self, file: ImageMarkingController, changed_from: Optional[int] = None):
+        """ Bring the canvas mark items in line with the marks of the file, redrawing marks from changed_from on """
+        marks = file.image.mark_list
+        self.canvas_block.remove_marks(start=len(marks) if changed_from is None else min(changed_from, len(marks)))
+        for mark in marks[self.canvas_block.mark_count:]:
+            self.canvas_block.draw_mark(
+                mark.x, mark.y, str(mark.number), mark.r, font_size=mark.FONT_SIZE,
+                fill=mark.FILL, outline=mark.OUTLINE, text_fill=mark.TEXT_FILL)
+
     def place_mark(self, event):
         if not self.file_manager.files_list:
             return
         x = self.canvas_block.canvasx(event.x)
         y = self.canvas_block.canvasy(event.y)
         current_file: ImageMarkingController = self.file_manager.get_current_file()
-        current_file.add_mark(*self.canvas_block.get_image_coords(x, y))
-        self.canvas_block.load_image(current_file.render_image(), update_current=True)
+        changed_box = current_file.add_mark(*self.canvas_block.get_image_coords(x, y))
+        if self.uses_canvas_marks(current_file):
+            self.sync_canvas_marks(current_file)
+        elif changed_box:
+            self.canvas_block.update_region(changed_box)
 
     def remove_mark(self, clear_all=False):
         if not self.file_manager.files_list:
             return
         current_file: ImageMarkingController = self.file_manager.get_current_file()
-        current_file.remove_mark(clear_all=clear_all)
-        self.canvas_block.load_image(current_file.render_image(), update_current=True)
+        changed_box = current_file.remove_mark(clear_all=clear_all)
+        if self.uses_canvas_marks(current_file):
+            self.sync_canvas_marks(current_file)
+        elif changed_box:
+            self.canvas_block.update_region(changed_box)
+
+    def get_event_image_coords(self, event) -> Tuple[int, int]:
+        x = self.canvas_block.canvasx(event.x)
+        y = self.canvas_block.canvasy(event.y)
+        return self.canvas_block.get_image_coords(x, y)
+
+    def remove_mark_under_cursor(self, event):
+        if not self.file_manager.files_list:
+            return
+        current_file: ImageMarkingController = self.file_manager.get_current_file()
+        position = current_file.find_mark(*self.get_event_image_coords(event))
+        if position is None:
+            return
+        changed_box = current_file.remove_mark_at(position)
+        if self.uses_canvas_marks(current_file):
+            self.sync_canvas_marks(current_file, changed_from=position)
+        elif changed_box:
+            self.canvas_block.update_region(changed_box)
+
+    def pick_mark(self, event):
+        if not self.file_manager.files_list:
+            return
+        current_file: ImageMarkingController = self.file_manager.get_current_file()
+        self.picked_mark = current_file.find_mark(*self.get_event_image_coords(event))
+
+    def drag_mark(self, event):
+        if self.picked_mark is not None and self.file_manager.files_list:
+            current_file: ImageMarkingController = self.file_manager.get_current_file()
+            x, y = self.get_event_image_coords(event)
+            self.canvas_block.show_mark_preview(x, y, current_file.image.mark_list[self.picked_mark].r)
+        return 'break'  # the press was a shift press, there is no pan to continue
+
+    def cancel_mark_drag(self, event):
+        self.picked_mark = None
+        self.canvas_block.hide_mark_preview()
+
+    def drop_mark(self, event):
+        position, self.picked_mark = self.picked_mark, None
+        self.canvas_block.hide_mark_preview()
+        if position is None or not self.file_manager.files_list:
+            return
+        current_file: ImageMarkingController = self.file_manager.get_current_file()
+        changed_box = current_file.move_mark(position, *self.get_event_image_coords(event))
+        if self.uses_canvas_marks(current_file):
+            self.sync_canvas_marks(current_file, changed_from=position)
+        elif changed_box:
+            self.canvas_block.update_region(changed_box)
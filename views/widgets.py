@@ -1,10 +1,19 @@
 import math
+import time
 import tkinter as tk
 
+from collections import OrderedDict
 from tkinter import ttk
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-from PIL import Image, ImageTk
+from PIL import Image
+
+if TYPE_CHECKING:
+    from PIL import ImageTk
+
+from config import config
+from instrumentation import tracer
+from models.tiled_image import TiledImage
 
 
 class AutoScrollbar(ttk.Scrollbar):
@@ -27,32 +36,48 @@ class AutoScrollbar(ttk.Scrollbar):
 class ZoomCanvas(tk.Canvas):
     """ With help from https://stackoverflow.com/a/48137257 """
 
+    INTERACTIVE_FILTERS = {'nearest': Image.NEAREST, 'bilinear': Image.BILINEAR, 'lanczos': Image.LANCZOS}
+
     def __init__(self, image_frame: tk.Frame, *args, **kwargs):
-        self.image_tk = None
         self.container: int = 0
-        self.__pyramid: List = []
+        self.__pyramid: List[Optional[Image.Image]] = []  # levels are made when the zoom first needs them
+        # Pyramids of the last few images, showing one of them again reuses the levels made so far
+        self.__pyramids: 'OrderedDict[int, List[Optional[Image.Image]]]' = OrderedDict()  # id of the base image
         self.__min_side: int = 0
         self.img_height: int = 0
         self.img_width: int = 0
         self.__image: Optional[Image] = None
+        self.__source: Optional[TiledImage] = None  # large image read tile by tile, shown without the pyramid
+        self.__mark_items: List[Tuple[int, int]] = []  # (oval, text) canvas items of the marks, in mark order
+        self.__mark_font_size = 16  # in image pixels, scaled with the zoom
 
         self.img_scale = 1.0  # scale for the canvas image zoom, public for outer classes
         self.__delta = 1.3  # zoom magnitude
         self.__filter = Image.LANCZOS
+        # Cheaper filter for frames drawn while the user is panning or zooming, refined once the input stops
+        self.__interactive_filter = self.INTERACTIVE_FILTERS[config.interactive_filter]
+        self.__refine_job = None
 
-        # Vertical and horizontal scrollbars for canvas
-        h_bar = AutoScrollbar(image_frame, orient='horizontal')
-        v_bar = AutoScrollbar(image_frame, orient='vertical')
-        h_bar.grid(row=1, column=0, sticky='we')
-        v_bar.grid(row=0, column=1, sticky='ns')
+        # Input events only mark the view dirty, it's drawn at most once per frame
+        self.__frame_job = None
+        self.__frame_interactive = True  # whether all redraws requested for the next frame came from input
+        self.__last_frame_time = 0.0
+        self.__pending_zoom: Optional[List[float]] = None  # [x, y, scale] of wheel steps not yet applied to the items
 
+        h_bar, v_bar = self.make_scrollbars(image_frame)
         super(ZoomCanvas, self).__init__(
             image_frame, *args, highlightthickness=0, xscrollcommand=h_bar.set, yscrollcommand=v_bar.set, **kwargs)
 
         h_bar.configure(command=self.__scroll_x)  # bind scrollbars to the canvas
         v_bar.configure(command=self.__scroll_y)
 
-        self.__band_width = 1024  # width of the tile band
+        # Visible area is drawn with fixed-size tiles, cached as PhotoImages per pyramid level and zoom
+        self.__tile_size = config.tile_size
+        self.__tile_cache_size = config.tile_cache_size
+        # Tiles and canvas items of the placed tiles keep a flag whether they were drawn with the full quality filter
+        self.__tiles: 'OrderedDict[Tuple[int, float, int, int], Tuple[ImageTk.PhotoImage, bool]]' = OrderedDict()
+        self.__tile_items: Dict[Tuple[int, float, int, int], Tuple[int, 'ImageTk.PhotoImage', bool]] = {}
+        self.__tiles_scale: Optional[float] = None  # zoom of the placed tiles
 
         # Set ratio coefficient for image pyramid
         self.__ratio = 1.0
@@ -60,22 +85,73 @@ class ZoomCanvas(tk.Canvas):
         self.__scale = self.img_scale * self.__ratio  # image pyramid scale
         self.__reduction = 2  # reduction degree of image pyramid
 
+    @staticmethod
+    def make_scrollbars(image_frame: tk.Frame) -> Tuple[AutoScrollbar, AutoScrollbar]:
+        """ Vertical and horizontal scrollbars for canvas """
+        h_bar = AutoScrollbar(image_frame, orient='horizontal')
+        v_bar = AutoScrollbar(image_frame, orient='vertical')
+        h_bar.grid(row=1, column=0, sticky='we')
+        v_bar.grid(row=0, column=1, sticky='ns')
+        return h_bar, v_bar
+
+    @staticmethod
+    def make_photo_image(tile: Image.Image) -> 'ImageTk.PhotoImage':
+        from PIL import ImageTk  # loaded with the first tile shown, not on startup
+        return ImageTk.PhotoImage(tile)
+
     # noinspection PyUnusedLocal
     def __scroll_x(self, *args, **kwargs):
         """ Scroll canvas horizontally and redraw the image """
         self.xview(*args)  # scroll horizontally
-        self.show_image()  # redraw the image
+        self.request_redraw()  # redraw the image
 
     # noinspection PyUnusedLocal
     def __scroll_y(self, *args, **kwargs):
         """ Scroll canvas vertically and redraw the image """
         self.yview(*args)  # scroll vertically
-        self.show_image()  # redraw the image
+        self.request_redraw()  # redraw the image
+
+    def request_redraw(self, interactive: bool = True):
+        """ Mark the view dirty, bursts of requests are drawn once, no more often than config.frame_interval """
+        self.__frame_interactive = self.__frame_interactive and interactive
+        if self.__frame_job:
+            return
+        wait = config.frame_interval - (time.monotonic() - self.__last_frame_time) * 1000
+        if wait > 0:
+            self.__frame_job = self.after(int(wait) + 1, self.__draw_frame)
+        else:
+            self.__frame_job = self.after_idle(self.__draw_frame)
+
+    def __draw_frame(self):
+        self.__frame_job = None
+        self.__last_frame_time = time.monotonic()
+        interactive = self.__frame_interactive
+        self.__frame_interactive = True
+        self.show_image(interactive=interactive)
+
+    def __apply_pending_zoom(self):
+        """ Scale the canvas items by the wheel steps collected since the last frame """
+        if not self.__pending_zoom:
+            return
+        x, y, scale = self.__pending_zoom
+        self.__pending_zoom = None
+        self.scale('all', x, y, scale, scale)  # rescale all objects
+        if self.__mark_items:
+            self.itemconfigure('mark_text', font=self.__get_mark_font())  # text is not scaled with the objects
 
-    def show_image(self):
+    @tracer.traced('show_image')
+    def show_image(self, interactive: bool = False):
+        """
+        Show image on the Canvas. Implements correct image zoom almost like in Google Maps.
+        Interactive frames are drawn with the cheaper filter and redrawn with the full one after a pause in the input.
+        """
         if not self.container:
             return
-        """ Show image on the Canvas. Implements correct image zoom almost like in Google Maps """
+        self.__apply_pending_zoom()
+        interactive = interactive and config.progressive_rendering
+        if self.__refine_job:
+            self.after_cancel(self.__refine_job)
+            self.__refine_job = None
         box_image = self.coords(self.container)  # get image area
         box_canvas = (self.canvasx(0),  # get visible area of the canvas
                       self.canvasy(0),
@@ -100,38 +176,223 @@ class ZoomCanvas(tk.Canvas):
         x2 = min(box_canvas[2], box_image[2]) - box_image[0]
         y2 = min(box_canvas[3], box_image[3]) - box_image[1]
         if int(x2 - x1) > 0 and int(y2 - y1) > 0:  # show image if it in the visible area
-            image = self.__pyramid[max(0, self.__curr_img)].crop(  # crop current img from pyramid
-                (int(x1 / self.__scale), int(y1 / self.__scale),
-                 int(x2 / self.__scale), int(y2 / self.__scale)))
-            image_tk = ImageTk.PhotoImage(image.resize((int(x2 - x1), int(y2 - y1)), self.__filter))
-            image_id = self.create_image(
-                max(box_canvas[0], box_img_int[0]),
-                max(box_canvas[1], box_img_int[1]),
-                anchor='nw', image=image_tk)
-            self.lower(image_id)  # set image into background
-            self.image_tk = image_tk  # keep an extra reference to prevent garbage-collection
-
-    def load_image(self, image: Image, update_current: bool = False):
+            self.__show_tiles(box_image, x1, y1, x2, y2, final=not interactive)
+            if interactive:
+                self.__refine_job = self.after(config.refine_delay, self.__refine_tiles)
+
+    def __refine_tiles(self):
+        """ Redraw the placed tiles drawn with the interactive filter """
+        self.__refine_job = None
+        box_image = self.coords(self.container)
+        for key, (image_id, image_tk, final) in list(self.__tile_items.items()):
+            if not final:
+                image_tk = self.__get_tile(key, box_image, final=True)
+                self.itemconfigure(image_id, image=image_tk)
+                self.__tile_items[key] = (image_id, image_tk, True)
+
+    def __show_tiles(self, box_image: List[float], x1: float, y1: float, x2: float, y2: float, final: bool = True):
+        """ Place the tiles covering the visible part (x1,y1,x2,y2) of the image, reusing the ones already placed """
+        scale_key = round(self.img_scale, 9)  # repeated zoom in and out leaves float noise in the scale
+        if scale_key != self.__tiles_scale:
+            # Tile items are moved by self.scale('all', ...) but their pixels are not, so they are placed anew
+            self.delete('tile')
+            self.__tile_items.clear()
+            self.__tiles_scale = scale_key
+        level = max(0, self.__curr_img)
+        size = self.__tile_size
+        visible = set()
+        for ty in range(int(y1 // size), int((y2 - 1) // size) + 1):
+            for tx in range(int(x1 // size), int((x2 - 1) // size) + 1):
+                key = (level, scale_key, tx, ty)
+                visible.add(key)
+                if key in self.__tile_items and (self.__tile_items[key][2] or not final):
+                    continue
+                if key in self.__tile_items:
+                    self.delete(self.__tile_items.pop(key)[0])
+                image_tk = self.__get_tile(key, box_image, final=final)
+                if not image_tk:
+                    continue
+                image_id = self.create_image(
+                    box_image[0] + tx * size, box_image[1] + ty * size, anchor='nw', image=image_tk, tags='tile')
+                self.lower(image_id)  # set image into background
+                # keep a reference to prevent garbage-collection
+                self.__tile_items[key] = (image_id, image_tk, self.__tiles[key][1])
+        for key in [key for key in self.__tile_items if key not in visible]:
+            self.delete(self.__tile_items.pop(key)[0])
+
+    def __get_tile(
+            self, key: Tuple[int, float, int, int], box_image: List[float], final: bool = True
+    ) -> Optional['ImageTk.PhotoImage']:
+        """ Tile from the cache, or cropped and resized from the pyramid. Final tiles use the full quality filter """
+        cached = self.__tiles.get(key)
+        if cached and (cached[1] or not final):
+            self.__tiles.move_to_end(key)
+            return cached[0]
+        level, _, tx, ty = key
+        size = self.__tile_size
+        width = int(box_image[2] - box_image[0])  # size of the whole image on the screen
+        height = int(box_image[3] - box_image[1])
+        x1, y1 = tx * size, ty * size
+        x2, y2 = min(x1 + size, width), min(y1 + size, height)
+        if x2 <= x1 or y2 <= y1:
+            return None
+        image_filter = self.__filter if final else self.__interactive_filter
+        if self.__source:
+            box = (x1 / self.img_scale, y1 / self.img_scale,
+                   min(x2 / self.img_scale, self.img_width), min(y2 / self.img_scale, self.img_height))
+            tile = self.__source.get_region(box, (x2 - x1, y2 - y1), image_filter)
+        else:
+            image = self.__get_level(level)
+            box = (x1 / self.__scale, y1 / self.__scale,
+                   min(x2 / self.__scale, image.width), min(y2 / self.__scale, image.height))
+            tile = image.resize((x2 - x1, y2 - y1), image_filter, box=box)
+        image_tk = self.make_photo_image(tile)
+        tracer.count('photoimages')
+        self.__tiles[key] = (image_tk, final)
+        self.__tiles.move_to_end(key)
+        while len(self.__tiles) > self.__tile_cache_size:
+            self.__tiles.popitem(last=False)
+        return image_tk
+
+    def __clear_tiles(self):
+        self.delete('tile')
+        self.__tile_items.clear()
+        self.__tiles.clear()
+
+    def __invalidate_tiles(self, box: Tuple[int, int, int, int]):
+        """ Drop the tiles showing the box (in image pixels) of the loaded image """
+        size = self.__tile_size
+        for key in list(self.__tiles.keys() | self.__tile_items.keys()):
+            _, scale, tx, ty = key
+            if (tx * size < box[2] * scale and box[0] * scale < (tx + 1) * size and
+                    ty * size < box[3] * scale and box[1] * scale < (ty + 1) * size):
+                self.__tiles.pop(key, None)
+                if key in self.__tile_items:
+                    self.delete(self.__tile_items.pop(key)[0])
+
+    @tracer.traced('load_image')
+    def load_image(self, image: Union[Image.Image, TiledImage], update_current: bool = False):
+        """ A TiledImage is read tile by tile as the view needs it, it starts zoomed to fit the window """
         self.__image = image
-        # Create image pyramid
-        self.__pyramid = [self.__image]
-        w, h = self.__pyramid[-1].size
-        while w > 512 and h > 512:  # top pyramid image is around 512 pixels in size
-            w /= self.__reduction  # divide on reduction degree
-            h /= self.__reduction  # divide on reduction degree
-            self.__pyramid.append(self.__pyramid[-1].resize((int(w), int(h)), self.__filter))
+        self.__clear_tiles()
+        self.__source = image if isinstance(image, TiledImage) else None
+        # Image pyramid, only the base level is there until zooming out needs more. A tiled image has its own levels
+        self.__pyramid = [] if self.__source else self.__get_pyramid(image)
+        if update_current and self.__pyramid:
+            self.__pyramid[1:] = [None] * (len(self.__pyramid) - 1)  # pixels may have changed, make them anew
         # Put image into container rectangle and use it to set proper coordinates to the image
         if not update_current:
+            self.__pending_zoom = None  # meant for the previous image
             self.img_scale = 1.0  # scale for the canvas image zoom, public for outer classes
             self.__curr_img = 0  # current image from the pyramid
             self.__scale = self.img_scale * self.__ratio  # image pyramid scale
             # Create new container for new image
             self.img_width, self.img_height = self.__image.size  # public for outer classes
             self.__min_side = min(self.img_width, self.img_height)  # get the smaller image side
+            if self.container:
+                self.delete(self.container)
             self.container = self.create_rectangle((0, 0, self.img_width, self.img_height), width=0)
+            self.clear_marks()
+            if self.__source:
+                fit = min(self.winfo_width() / self.img_width, self.winfo_height() / self.img_height)
+                if fit < 1:
+                    self.scale('all', 0, 0, fit, fit)
+                    self.img_scale = fit
         self.show_image()  # show image on the canvas
         self.focus_set()  # set focus on the canvas
 
+    def __get_pyramid(self, image: Image.Image) -> List[Optional[Image.Image]]:
+        pyramid = self.__pyramids.get(id(image))
+        if pyramid and pyramid[0] is image:  # the pyramid holds its base, so the id can't be reused meanwhile
+            self.__pyramids.move_to_end(id(image))
+            return pyramid
+        pyramid = [image]
+        w, h = image.size
+        while w > 512 and h > 512:  # top pyramid image is around 512 pixels in size
+            w /= self.__reduction  # divide on reduction degree
+            h /= self.__reduction  # divide on reduction degree
+            pyramid.append(None)
+        self.__pyramids[id(image)] = pyramid
+        while len(self.__pyramids) > 4:
+            self.__pyramids.popitem(last=False)
+        return pyramid
+
+    def __get_level(self, level: int) -> Image.Image:
+        """ Pyramid level, made from the one below when it's first needed """
+        if self.__pyramid[level] is None:
+            below = self.__get_level(level - 1)
+            with tracer.span('pyramid_level', level=level):
+                self.__pyramid[level] = below.resize(
+                    (below.width // self.__reduction, below.height // self.__reduction), self.__filter)
+        return self.__pyramid[level]
+
+    def update_region(self, box: Tuple[int, int, int, int]):
+        """ Refresh the pyramid after the pixels inside the box of the loaded image were changed in place """
+        if self.__source:
+            return  # marks of large images are canvas items, their pixels never change
+        self.__invalidate_tiles(box)
+        for i in range(1, len(self.__pyramid)):
+            source, level = self.__pyramid[i - 1], self.__pyramid[i]
+            if level is None:
+                break  # not made yet, it will be made from the patched level below
+            kx = level.width / source.width
+            ky = level.height / source.height
+            # Grow the box by the filter support, so its edges are resampled just like in __get_level
+            box = (max(0, math.floor(box[0] * kx) - 3), max(0, math.floor(box[1] * ky) - 3),
+                   min(level.width, math.ceil(box[2] * kx) + 3), min(level.height, math.ceil(box[3] * ky) + 3))
+            patch = source.resize(
+                (box[2] - box[0], box[3] - box[1]), self.__filter,
+                box=(box[0] / kx, box[1] / ky, box[2] / kx, box[3] / ky))
+            level.paste(patch, box[:2])
+        self.show_image()
+
+    @property
+    def mark_count(self) -> int:
+        return len(self.__mark_items)
+
+    def draw_mark(
+            self, x: int, y: int, text: str, r: int, font_size: int = 16,
+            fill: str = 'white', outline: str = 'red', text_fill: str = 'black'):
+        """ Draw a circled text mark at image coords (x,y) as canvas items, they are moved and zoomed with the image """
+        self.__apply_pending_zoom()
+        bbox = self.coords(self.container)  # get image area
+        cx = bbox[0] + x * self.img_scale
+        cy = bbox[1] + y * self.img_scale
+        cr = r * self.img_scale
+        self.__mark_font_size = font_size
+        oval = self.create_oval(cx - cr, cy - cr, cx + cr, cy + cr, fill=fill, outline=outline, width=2, tags='mark')
+        text_item = self.create_text(
+            cx, cy, text=text, fill=text_fill, font=self.__get_mark_font(), tags=('mark', 'mark_text'))
+        self.__mark_items.append((oval, text_item))
+
+    def remove_marks(self, start: int = 0):
+        """ Remove the canvas items of the marks from position start onwards """
+        for items in self.__mark_items[start:]:
+            self.delete(*items)
+        del self.__mark_items[start:]
+
+    def clear_marks(self):
+        self.delete('mark')
+        self.__mark_items.clear()
+
+    def show_mark_preview(self, x: int, y: int, r: int):
+        """ Outline of a mark being dragged to image coords (x,y) """
+        self.__apply_pending_zoom()
+        bbox = self.coords(self.container)  # get image area
+        cx = bbox[0] + x * self.img_scale
+        cy = bbox[1] + y * self.img_scale
+        cr = r * self.img_scale
+        if not self.find_withtag('mark_preview'):
+            self.create_oval(0, 0, 0, 0, outline='red', dash=(4, 2), width=2, tags='mark_preview')
+        self.coords('mark_preview', cx - cr, cy - cr, cx + cr, cy + cr)
+        self.tag_raise('mark_preview')
+
+    def hide_mark_preview(self):
+        self.delete('mark_preview')
+
+    def __get_mark_font(self) -> Tuple[str, int]:
+        return 'Helvetica', -max(1, round(self.__mark_font_size * self.img_scale))  # negative size is in pixels
+
     def is_outside(self, x, y):
         """ Checks if the point (x,y) is outside the image area """
         if not self.container:
@@ -164,11 +425,19 @@ class ZoomCanvas(tk.Canvas):
         self.__curr_img = min((-1) * int(math.log(k, self.__reduction)), len(self.__pyramid) - 1)
         self.__scale = k * math.pow(self.__reduction, max(0, self.__curr_img))
 
-        self.scale('all', x, y, scale, scale)  # rescale all objects
+        if self.__pending_zoom and self.__pending_zoom[:2] != [x, y]:
+            self.__apply_pending_zoom()  # steps around another point can't be merged
+        if self.__pending_zoom:
+            self.__pending_zoom[2] *= scale
+        else:
+            self.__pending_zoom = [x, y, scale]
+        if not config.coalesce_wheel:
+            self.__apply_pending_zoom()
         # Redraw some figures before showing image on the screen
-        self.show_image()
+        self.request_redraw()
 
     def get_image_coords(self, x: int, y: int) -> Tuple[int, int]:
+        self.__apply_pending_zoom()
         bbox = self.coords(self.container)  # get image area
         x1 = round((x - bbox[0]) / self.img_scale)  # get real (x,y) on the image without zoom
         y1 = round((y - bbox[1]) / self.img_scale)
@@ -181,4 +450,151 @@ class ZoomCanvas(tk.Canvas):
     def move_to(self, event):
         """ Drag (move) canvas to the new position """
         self.scan_dragto(event.x, event.y, gain=1)
-        self.show_image()  # zoom tile and show it on the canvas
+        self.request_redraw()  # zoom tile and show it on the canvas
+
+
+class Filmstrip(tk.Canvas):
+    """
+    Vertical strip of thumbnails. Only the cells in view have canvas items and PhotoImages,
+    the rest of the strip is just its scroll region
+    """
+
+    LABEL_HEIGHT = 16
+    PADDING = 6
+
+    def __init__(
+            self, frame: tk.Frame, thumbnail_size: int = 128, get_label: Optional[Callable[[int], str]] = None,
+            on_select: Optional[Callable[[int], None]] = None,
+            on_request: Optional[Callable[[Sequence[int]], None]] = None, cache_size: int = 512, **kwargs):
+        self.thumbnail_size = thumbnail_size
+        self.cell_height = thumbnail_size + self.LABEL_HEIGHT + 2 * self.PADDING
+        self.get_label = get_label  # text under the thumbnail at index
+        self.on_select = on_select  # called with the index of the clicked cell
+        self.on_request = on_request  # called with the indices in view that have no thumbnail yet
+        self.count = 0
+        self.selected: Optional[int] = None
+        self.__cache_size = cache_size
+        # Thumbnails received so far, None for files that could not be read
+        self.__thumbnails: 'OrderedDict[int, Optional[Image.Image]]' = OrderedDict()
+        # Canvas items of the cells in view and the PhotoImage each one shows, kept against garbage-collection
+        self.__cells: Dict[int, Tuple[Tuple[int, ...], Optional['ImageTk.PhotoImage']]] = {}
+        self.__refresh_job = None
+
+        v_bar = AutoScrollbar(frame, orient='vertical')
+        v_bar.grid(row=0, column=1, sticky='ns')
+        super(Filmstrip, self).__init__(
+            frame, highlightthickness=0, width=thumbnail_size + 2 * self.PADDING, yscrollcommand=v_bar.set,
+            **kwargs)
+        v_bar.configure(command=self.__scroll_y)
+
+        self.bind('<Configure>', lambda event: self.request_refresh())
+        self.bind('<Button-1>', self.__click)
+        self.bind('<MouseWheel>', self.__wheel)  # Windows and macOS
+        self.bind('<Button-4>', self.__wheel)  # Linux, wheel scroll up
+        self.bind('<Button-5>', self.__wheel)  # Linux, wheel scroll down
+
+    # noinspection PyUnusedLocal
+    def __scroll_y(self, *args, **kwargs):
+        self.yview(*args)
+        self.request_refresh()
+
+    def __wheel(self, event):
+        self.yview_scroll(-1 if event.num == 4 or event.delta > 0 else 1, 'units')
+        self.request_refresh()
+
+    def __click(self, event):
+        index = int(self.canvasy(event.y) // self.cell_height)
+        if 0 <= index < self.count and self.on_select:
+            self.on_select(index)
+
+    def reset(self):
+        """ Forget all cells and thumbnails, for a new list of files """
+        self.invalidate()
+        self.count = 0
+        self.selected = None
+        self.yview_moveto(0)
+        self.request_refresh()
+
+    def invalidate(self):
+        """ Redraw all cells with thumbnails asked for anew, after files were inserted or removed in the list """
+        self.delete('all')
+        self.__cells.clear()
+        self.__thumbnails.clear()
+        self.request_refresh()
+
+    def set_count(self, count: int):
+        if count != self.count:
+            self.count = count
+            self.request_refresh()
+
+    def set_selected(self, index: int):
+        """ Highlight the cell at index and scroll it into view """
+        previous, self.selected = self.selected, index
+        for i in (previous, index):
+            if i in self.__cells:
+                self.__redraw_cell(i)
+        top = self.canvasy(0)
+        bottom = self.canvasy(self.winfo_height())
+        if self.count and not (top <= index * self.cell_height and (index + 1) * self.cell_height <= bottom):
+            self.yview_moveto(max(0.0, (index + 0.5) * self.cell_height - (bottom - top) / 2) /
+                              (self.count * self.cell_height))
+        self.request_refresh()
+
+    def set_thumbnail(self, index: int, image: Optional[Image.Image]):
+        self.__thumbnails[index] = image
+        self.__thumbnails.move_to_end(index)
+        while len(self.__thumbnails) > self.__cache_size:
+            self.__thumbnails.popitem(last=False)
+        if index in self.__cells:
+            self.__redraw_cell(index)
+
+    def request_refresh(self):
+        """ Scrolling only marks the strip dirty, the cells are updated once the events are handled """
+        if not self.__refresh_job:
+            self.__refresh_job = self.after_idle(self.refresh)
+
+    def refresh(self):
+        """ Draw the cells in view, drop the ones scrolled out and ask for the missing thumbnails """
+        self.__refresh_job = None
+        self.configure(scrollregion=(0, 0, self.winfo_width(), self.count * self.cell_height))
+        first = max(0, int(self.canvasy(0) // self.cell_height))
+        last = min(self.count, int(self.canvasy(self.winfo_height()) // self.cell_height) + 1)
+        visible = range(first, last)
+        for index in [index for index in self.__cells if index not in visible]:
+            self.delete(*self.__cells.pop(index)[0])
+        missing = []
+        for index in visible:
+            if index not in self.__cells:
+                self.__draw_cell(index)
+            if index in self.__thumbnails:
+                self.__thumbnails.move_to_end(index)
+            else:
+                missing.append(index)
+        if missing and self.on_request:
+            self.on_request(missing)
+
+    def __draw_cell(self, index: int):
+        top = index * self.cell_height
+        center_x = self.winfo_width() / 2
+        selected = index == self.selected
+        items = [self.create_rectangle(
+            1, top + 1, self.winfo_width() - 1, top + self.cell_height - 1, width=2,
+            outline='red' if selected else '', fill='#d9d9d9' if selected else '')]
+        image_tk = None
+        thumbnail = self.__thumbnails.get(index)
+        image_y = top + self.PADDING + self.thumbnail_size / 2
+        if thumbnail is not None:
+            from PIL import ImageTk
+            image_tk = ImageTk.PhotoImage(thumbnail)
+            items.append(self.create_image(center_x, image_y, image=image_tk))
+        elif index in self.__thumbnails:
+            items.append(self.create_text(center_x, image_y, text='?'))  # the file could not be read
+        label = self.get_label(index) if self.get_label else str(index + 1)
+        items.append(self.create_text(
+            center_x, top + self.cell_height - self.PADDING - self.LABEL_HEIGHT / 2, text=label,
+            width=self.thumbnail_size))
+        self.__cells[index] = (tuple(items), image_tk)
+
+    def __redraw_cell(self, index: int):
+        self.delete(*self.__cells.pop(index)[0])
+        self.__draw_cell(index)